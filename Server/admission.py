@@ -0,0 +1,117 @@
+import asyncio
+import collections
+from aiohttp import web
+from budget import current_client
+from config import logger, ADMISSION_LIMITS, ADMISSION_RETRY_AFTER, UPSTREAM_CLIENT_HEADER
+
+class Overloaded(Exception):
+    pass
+
+class RouteLimiter:
+    # Ограничение одновременных запросов на маршрут с ограниченной очередью
+    # ожидания и дедлайном на время в очереди. Слот освобождённого запроса
+    # передаётся первому ожидающему (FIFO).
+
+    def __init__(self, limit, max_queue, queue_timeout):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = collections.deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def queued(self):
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    async def acquire(self):
+        if self.in_flight < self.limit and not self.queued:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот достался в последний момент
+                self.admitted += 1
+                return
+            waiter.cancel()
+            self.timed_out += 1
+            raise Overloaded()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+            raise
+        self.admitted += 1
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # in_flight не меняется: слот переходит ожидающему
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+def create_limiters(limits=ADMISSION_LIMITS):
+    return {
+        path: RouteLimiter(limit, max_queue, queue_timeout)
+        for path, (limit, max_queue, queue_timeout) in limits.items()
+    }
+
+# Клиент для справедливой очереди к OpenAI: IP или заголовок от прокси
+def client_key(request):
+    if UPSTREAM_CLIENT_HEADER:
+        value = request.headers.get(UPSTREAM_CLIENT_HEADER)
+        if value:
+            return value.split(",")[0].strip()
+    return request.remote or "unknown"
+
+# Middleware контроля допуска: лишние запросы отбрасываются сразу с 503,
+# пока не заняли соединение к OpenAI и слот пула БД
+async def admission_middleware(app, handler):
+    async def middleware_handler(request):
+        limiter = app['admission'].get(request.path)
+        if limiter is None:
+            return await handler(request)
+
+        try:
+            await limiter.acquire()
+        except Overloaded:
+            logger.warning(f"Shedding request to {request.path}: {limiter.in_flight} in flight, {limiter.queued} queued")
+            return web.json_response(
+                {"error": "Server is busy, try again later"},
+                status=503,
+                headers={"Retry-After": str(ADMISSION_RETRY_AFTER)}
+            )
+        token = current_client.set(client_key(request))
+        try:
+            return await handler(request)
+        finally:
+            current_client.reset(token)
+            limiter.release()
+    return middleware_handler
@@ -0,0 +1,84 @@
+# Сравнение старого (LANCZOS, quality=100) и быстрого (draft + reduce) сжатия фото.
+#
+#   python benchmarks/bench_compress_image.py                 # синтетические фото
+#   python benchmarks/bench_compress_image.py --corpus ~/photos --repeat 5
+#
+# Каждое изображение в каждом режиме обрабатывается в отдельном процессе,
+# чтобы пиковый RSS относился именно к нему (Pillow выделяет память вне Python,
+# tracemalloc её не видит).
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common  # noqa: E402
+
+def _run(path, fast, repeat, queue):
+    import resource
+    common.quiet_logging()
+    from image_utils import compress_image
+
+    with open(path, "rb") as f:
+        data = f.read()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    output = b""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = compress_image(data, fast=fast)
+        timings.append(time.perf_counter() - started)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        "median_ms": statistics.median(timings) * 1000,
+        "peak_mb": max(0, peak_rss - baseline_rss) / 1024,
+        "output_bytes": len(output),
+    })
+
+def measure(path, fast, repeat):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run, args=(path, fast, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="compress_image benchmark: legacy vs fast decode")
+    parser.add_argument("--corpus", help="каталог с фото (по умолчанию — синтетические 1–48 МП)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.corpus:
+        paths = common.load_corpus(args.corpus)
+    else:
+        paths = common.build_corpus(os.path.join(tempfile.gettempdir(), "recipe_bench_corpus"))
+    if not paths:
+        parser.error("corpus is empty")
+
+    header = f"{'image':<28}{'mode':<8}{'median ms':>11}{'peak MB':>10}{'out KB':>9}"
+    print(header)
+    print("-" * len(header))
+    totals = {False: [], True: []}
+    for path in paths:
+        for fast in (False, True):
+            result = measure(path, fast, args.repeat)
+            totals[fast].append(result)
+            print(
+                f"{os.path.basename(path):<28}{'fast' if fast else 'legacy':<8}"
+                f"{result['median_ms']:>11.1f}{result['peak_mb']:>10.1f}{result['output_bytes'] / 1024:>9.1f}"
+            )
+
+    print("-" * len(header))
+    for key, label in (("median_ms", "time"), ("peak_mb", "peak memory"), ("output_bytes", "output size")):
+        legacy = sum(r[key] for r in totals[False])
+        fast = sum(r[key] for r in totals[True])
+        if legacy:
+            print(f"{label}: fast = {fast / legacy:.2f}x legacy")
+
+if __name__ == "__main__":
+    main()
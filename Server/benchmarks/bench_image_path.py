@@ -0,0 +1,205 @@
+# Микробенчмарк пути фото до OpenAI по этапам: сжатие (compress_image) и тело
+# запроса с картинкой в base64, записанное в сокет-заглушку: "body" — как отправляет
+# analyze_image_with_openai (Base64JsonPayload), "inline_body" — прежний способ
+# (строка base64, data URL в f-строке, json= в aiohttp) для сравнения.
+# Для каждого этапа — лучшее время из --repeat замеров, пик Python-аллокаций
+# (tracemalloc) и размер результата. С --baseline прогон сравнивается с сохранённым, и код выхода 1,
+# если какая-то величина выросла больше порога.
+#
+#   python benchmarks/bench_image_path.py --save baseline.json
+#   python benchmarks/bench_image_path.py --baseline baseline.json
+#   python benchmarks/bench_image_path.py --corpus ~/photos --sizes 12,48 --repeat 10
+#
+# tracemalloc видит только память Python: буферы Pillow в C-коде сюда не попадают
+# (пиковый RSS сжатия меряет bench_compress_image.py). Время сравнивается с отдельным,
+# более мягким порогом — оно шумнее, — а разница меньше --time-min-ms не считается.
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common  # noqa: E402
+
+from aiohttp.payload import JsonPayload  # noqa: E402
+
+METRICS = ("time_ms", "alloc_bytes", "output_bytes")
+
+class NullWriter:
+    # Сокет-заглушка: считает байты и выбрасывает их
+    def __init__(self):
+        self.size = 0
+
+    async def write(self, chunk):
+        self.size += len(chunk)
+
+def send(body):
+    # write() ни разу не ждёт, поэтому корутина выполняется за один шаг
+    writer = NullWriter()
+    try:
+        body.write(writer).send(None)
+    except StopIteration:
+        pass
+    return writer.size
+
+def compress(data):
+    from image_utils import compress_image
+    jpeg = compress_image(data)
+    return jpeg, len(jpeg)
+
+def streaming_body(jpeg):
+    from openai_utils import build_image_payload
+    from upstream_body import Base64JsonPayload, split_json_template
+    prefix, suffix = split_json_template(build_image_payload())
+    return None, send(Base64JsonPayload(prefix, jpeg, suffix))
+
+def inline_body(jpeg):
+    from openai_utils import build_image_payload
+    payload = build_image_payload()
+    base64_image = base64.b64encode(jpeg).decode("utf-8")
+    payload["messages"][0]["content"][1]["image_url"]["url"] = f"data:image/jpeg;base64,{base64_image}"
+    return None, send(JsonPayload(payload))
+
+# Сжатие получает файл, тела запроса — результат сжатия
+BODY_STAGES = (("body", streaming_body), ("inline_body", inline_body))
+
+# Замер длится не меньше этого: быстрые этапы повторяются в цикле
+MIN_SAMPLE_SECONDS = 0.02
+
+def measure(func, value, repeat):
+    # Время — без tracemalloc (он замедляет аллокации в разы): прогрев, затем
+    # лучший из repeat замеров. Потом отдельный прогон для пика аллокаций сверх
+    # уже занятого.
+    started = time.perf_counter()
+    func(value)
+    number = max(1, int(MIN_SAMPLE_SECONDS / max(time.perf_counter() - started, 1e-9)))
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        for _ in range(number):
+            func(value)
+        timings.append((time.perf_counter() - started) / number)
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    result, size = func(value)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {
+        "time_ms": min(timings) * 1000,
+        "alloc_bytes": peak - baseline,
+        "output_bytes": size,
+    }
+
+def run(paths, repeat):
+    results = {}
+    for path in paths:
+        name = os.path.basename(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        jpeg, results[f"{name}/compress"] = measure(compress, data, repeat)
+        for stage_name, func in BODY_STAGES:
+            _, results[f"{name}/{stage_name}"] = measure(func, jpeg, repeat)
+    return results
+
+def environment():
+    import PIL
+    from config import IMAGE_MAX_SIDE, IMAGE_FAST_DECODE, IMAGE_JPEG_QUALITY
+    return {
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "machine": platform.machine(),
+        "image_max_side": IMAGE_MAX_SIDE,
+        "image_fast_decode": IMAGE_FAST_DECODE,
+        "image_jpeg_quality": IMAGE_JPEG_QUALITY,
+    }
+
+def format_value(metric, value):
+    if metric == "time_ms":
+        return f"{value:.2f} ms"
+    return f"{value / 1024:.1f} KB"
+
+def compare(results, baseline, thresholds, time_min_ms):
+    # Регрессия — рост больше порога; новые и пропавшие замеры только сообщаются
+    regressions = []
+    for key, metrics in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            print(f"  new: {key}")
+            continue
+        for metric in METRICS:
+            old, new = previous.get(metric), metrics[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            if metric == "time_ms" and new - old < time_min_ms:
+                continue
+            if change > thresholds[metric]:
+                regressions.append(
+                    f"{key} {metric}: {format_value(metric, old)} -> {format_value(metric, new)} "
+                    f"(+{change:.0%}, threshold {thresholds[metric]:.0%})"
+                )
+    for key in baseline.keys() - results.keys():
+        print(f"  missing: {key}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="image path microbenchmark with regression thresholds")
+    parser.add_argument("--corpus", help="каталог с фото (по умолчанию — синтетические JPEG, PNG и HEIC->JPEG)")
+    parser.add_argument("--sizes", default="1,12,24,48", help="мегапиксели синтетических фото")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="записать результаты как базовые")
+    parser.add_argument("--baseline", help="сравнить с базовыми результатами")
+    parser.add_argument("--threshold", type=float, default=0.10, help="допустимый рост аллокаций и размера")
+    parser.add_argument("--time-threshold", type=float, default=0.25, help="допустимый рост времени")
+    parser.add_argument("--time-min-ms", type=float, default=1.0, help="меньший рост времени не регрессия")
+    args = parser.parse_args()
+    common.quiet_logging()
+
+    if args.corpus:
+        paths = common.load_corpus(args.corpus)
+    else:
+        sizes = tuple(int(size) for size in args.sizes.split(","))
+        paths = common.build_corpus(
+            os.path.join(tempfile.gettempdir(), "recipe_bench_corpus"),
+            sizes=sizes, formats=("JPEG", "PNG", "HEIC")
+        )
+    if not paths:
+        parser.error("corpus is empty")
+
+    results = run(paths, args.repeat)
+    header = f"{'image/stage':<36}{'best ms':>11}{'alloc KB':>11}{'out KB':>10}"
+    print(header)
+    print("-" * len(header))
+    for key, metrics in results.items():
+        print(f"{key:<36}{metrics['time_ms']:>11.2f}{metrics['alloc_bytes'] / 1024:>11.1f}"
+              f"{metrics['output_bytes'] / 1024:>10.1f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+        print(f"baseline saved to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("environment") != environment():
+            print(f"warning: baseline environment differs: {baseline.get('environment')}")
+        thresholds = {"time_ms": args.time_threshold, "alloc_bytes": args.threshold, "output_bytes": args.threshold}
+        regressions = compare(results, baseline["results"], thresholds, args.time_min_ms)
+        if regressions:
+            print(f"{len(regressions)} regressions:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("no regressions")
+
+if __name__ == "__main__":
+    main()
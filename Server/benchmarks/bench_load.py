@@ -0,0 +1,246 @@
+# Нагрузочный тест сервера против локальной заглушки OpenAI: RPS, p50/p95/p99 по
+# маршрутам, задержка event loop и пиковый RSS сервера (из /metrics).
+#
+#   python benchmarks/fake_openai.py --latency 0.8 --latency-dist lognormal --chunk-delay 0.02
+#   OPENAI_BASE_URL=http://127.0.0.1:8099/v1 python server.py
+#   python benchmarks/bench_load.py --duration 30 --concurrency 64
+#   python benchmarks/bench_load.py --rate 50 --mix upload_text=1
+#
+# По умолчанию — замкнутый цикл (--concurrency клиентов шлют запрос за запросом).
+# С --rate запросы приходят по Пуассону с заданной частотой, а задержка считается
+# от запланированного момента отправки: перегруженный сервер не прячет очередь.
+# Тексты и аудио в каждом запросе разные, фото — по кругу из --images штук, поэтому
+# после первого круга /upload попадает в кэш по перцептивному хэшу.
+# При SERVER_WORKERS > 1 /metrics отвечает случайный воркер — память и задержка
+# event loop будут только его.
+import argparse
+import asyncio
+import io
+import math
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common  # noqa: E402
+
+import aiohttp  # noqa: E402
+
+ENDPOINTS = ("upload", "upload_audio", "upload_text", "upload_daily_recipe")
+DEFAULT_MIX = "upload_text=4,upload=2,upload_audio=1,upload_daily_recipe=3"
+
+QUESTIONS = ("Как приготовить борщ", "Рецепт сырников", "Что приготовить из курицы",
+             "Ужин из гречки", "Салат с тунцом", "Быстрый завтрак")
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip().lstrip("/")
+        if name not in ENDPOINTS:
+            raise SystemExit(f"unknown endpoint {name!r}, expected one of {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def encode_photos(count, megapixels):
+    width, height = common.PHOTO_SIZES[megapixels]
+    photos = []
+    for seed in range(count):
+        buffer = io.BytesIO()
+        common.synthetic_photo(width, height, seed=seed).save(buffer, format="JPEG", quality=85)
+        photos.append(buffer.getvalue())
+    return photos
+
+class Workload:
+    # Тела запросов; FormData одноразовая, поэтому собирается на каждый запрос
+    def __init__(self, photos, audio_size):
+        self.photos = photos
+        self.audio_size = audio_size
+        self.sequence = 0
+
+    def request(self, endpoint):
+        self.sequence += 1
+        if endpoint == "upload_daily_recipe":
+            return "/upload_daily_recipe", None
+        # Сервер читает все поля как multipart, даже одно текстовое
+        form = aiohttp.FormData(default_to_multipart=True)
+        if endpoint == "upload_text":
+            form.add_field("text", f"{random.choice(QUESTIONS)} #{self.sequence}")
+        elif endpoint == "upload_audio":
+            # Разные байты — иначе сработает кэш расшифровок по SHA-256
+            form.add_field("audio", os.urandom(self.audio_size), filename="voice.m4a", content_type="audio/mp4")
+        else:
+            photo = self.photos[self.sequence % len(self.photos)]
+            form.add_field("image", photo, filename="photo.jpg", content_type="image/jpeg")
+        return f"/{endpoint}", form
+
+class Results:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+
+    def record(self, endpoint, status, latency):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        counts = self.statuses.setdefault(endpoint, {})
+        counts[status] = counts.get(status, 0) + 1
+
+async def send(session, url, workload, results, endpoint, scheduled_at):
+    path, form = workload.request(endpoint)
+    try:
+        async with session.post(url + path, data=form) as response:
+            await response.read()
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status = type(e).__name__
+    results.record(endpoint, status, time.perf_counter() - scheduled_at)
+
+async def closed_loop(session, url, workload, results, mix, concurrency, duration):
+    names, weights = list(mix), list(mix.values())
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        while time.perf_counter() < deadline:
+            endpoint = random.choices(names, weights)[0]
+            await send(session, url, workload, results, endpoint, time.perf_counter())
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+async def open_loop(session, url, workload, results, mix, rate, duration):
+    names, weights = list(mix), list(mix.values())
+    started = time.perf_counter()
+    scheduled_at = started
+    tasks = set()
+    while scheduled_at < started + duration:
+        scheduled_at += random.expovariate(rate)
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        endpoint = random.choices(names, weights)[0]
+        task = asyncio.create_task(send(session, url, workload, results, endpoint, scheduled_at))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+# Задержка event loop самого генератора: если она велика, цифры сервера недостоверны
+async def measure_own_lag(samples, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started - interval)
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (\S+)$')
+
+async def scrape(session, url):
+    try:
+        async with session.get(url + "/metrics") as response:
+            text = await response.text()
+    except aiohttp.ClientError:
+        return {}
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples
+
+def loop_lag(before, after):
+    # Квантили задержки event loop сервера за время теста по разнице корзин гистограммы
+    buckets = []
+    for (name, labels), value in after.items():
+        if name == "recipe_event_loop_lag_seconds_bucket":
+            le = labels.split('le="')[1].rstrip('"}')
+            bound = math.inf if le == "+Inf" else float(le)
+            buckets.append((bound, value - before.get((name, labels), 0)))
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+
+    def quantile(q):
+        for bound, count in buckets:
+            if count >= q * total:
+                return bound
+        return math.inf
+
+    lag_sum = after.get(("recipe_event_loop_lag_seconds_sum", ""), 0) - before.get(("recipe_event_loop_lag_seconds_sum", ""), 0)
+    return {"mean": lag_sum / total, "p50": quantile(0.5), "p99": quantile(0.99), "max": quantile(1.0)}
+
+def format_ms(seconds):
+    return "   inf" if seconds == math.inf else f"{seconds * 1000:6.0f}"
+
+def report(results, elapsed, before, after, own_lag):
+    print(f"{'endpoint':<22}{'requests':>9}{'RPS':>8}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'max ms':>8}  statuses")
+    total = 0
+    for endpoint in ENDPOINTS:
+        latencies = results.latencies.get(endpoint)
+        if not latencies:
+            continue
+        total += len(latencies)
+        statuses = " ".join(f"{status}:{count}" for status, count in sorted(results.statuses[endpoint].items(), key=str))
+        print(f"/{endpoint:<21}{len(latencies):>9}{len(latencies) / elapsed:>8.1f}"
+              f"{format_ms(percentile(latencies, 0.5)):>8}{format_ms(percentile(latencies, 0.95)):>8}"
+              f"{format_ms(percentile(latencies, 0.99)):>8}{format_ms(max(latencies)):>8}  {statuses}")
+    print(f"total {total} requests in {elapsed:.1f} s, {total / elapsed:.1f} RPS")
+
+    lag = loop_lag(before, after)
+    if lag:
+        # Корзины гистограммы: p50/p99/max — верхние границы корзин
+        print(f"server event loop lag: mean {lag['mean'] * 1000:.1f} ms, p50 <= {format_ms(lag['p50']).strip()} ms, "
+              f"p99 <= {format_ms(lag['p99']).strip()} ms, max <= {format_ms(lag['max']).strip()} ms")
+    memory = {labels: value for (name, labels), value in after.items() if name == "recipe_process_memory"}
+    if memory:
+        rss = memory.get('{field="rss_bytes"}')
+        peak = memory.get('{field="peak_rss_bytes"}')
+        print(f"server memory: rss {rss / 2**20:.0f} MiB, peak rss {peak / 2**20:.0f} MiB" if rss and peak
+              else f"server memory: {memory}")
+    if not lag and not memory:
+        print("server /metrics unavailable: no event loop lag or memory figures")
+    if own_lag:
+        print(f"load generator loop lag: p99 {percentile(own_lag, 0.99) * 1000:.1f} ms")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=32, help="closed-loop clients")
+    parser.add_argument("--rate", type=float, default=0, help="open-loop arrivals per second (overrides --concurrency)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint=weight,...")
+    parser.add_argument("--images", type=int, default=16, help="distinct photos for /upload")
+    parser.add_argument("--photo-mp", type=int, default=12, choices=sorted(common.PHOTO_SIZES))
+    parser.add_argument("--audio-kb", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    mix = parse_mix(args.mix)
+    photos = encode_photos(args.images, args.photo_mp) if "upload" in mix else []
+    workload = Workload(photos, args.audio_kb * 1024)
+    results = Results()
+    own_lag = []
+
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        before = await scrape(session, args.url)
+        lag_task = asyncio.create_task(measure_own_lag(own_lag))
+        started = time.perf_counter()
+        if args.rate:
+            await open_loop(session, args.url, workload, results, mix, args.rate, args.duration)
+        else:
+            await closed_loop(session, args.url, workload, results, mix, args.concurrency, args.duration)
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        after = await scrape(session, args.url)
+
+    report(results, elapsed, before, after, own_lag)
+
+if __name__ == "__main__":
+    asyncio.run(main())
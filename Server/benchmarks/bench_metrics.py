@@ -0,0 +1,40 @@
+# Стоимость метрик на горячем пути: observe(), замер этапа и рендер /metrics.
+#
+#   python benchmarks/bench_metrics.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common  # noqa: E402,F401
+
+from metrics import Histogram, Registry, stage  # noqa: E402
+
+def main():
+    number = 200000
+    histogram = Histogram("bench_seconds", "benchmark", ("handler", "stage"))
+    registry = Registry()
+    registry.register(histogram)
+    values = [i / 1000 for i in range(1000)]
+
+    def observe():
+        for value in values:
+            histogram.observe(value, "/upload", "compress")
+
+    def timer():
+        with stage("compress"):
+            pass
+
+    observe_ns = min(timeit.repeat(observe, number=number // 1000, repeat=5)) / number * 1e9
+    timer_ns = min(timeit.repeat(timer, number=number, repeat=5)) / number * 1e9
+    for handler in ("/upload", "/upload_audio", "/upload_text", "/upload_daily_recipe"):
+        for stage_name in ("multipart", "compress", "request_body", "openai", "whisper", "db_acquire", "db_query"):
+            histogram.observe(0.1, handler, stage_name)
+    render_us = min(timeit.repeat(registry.render, number=100, repeat=5)) / 100 * 1e6
+
+    print(f"Histogram.observe:        {observe_ns:8.0f} ns/op")
+    print(f"with stage(...):          {timer_ns:8.0f} ns/op")
+    print(f"render ({len(histogram._series)} series):      {render_us:8.0f} us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Повторы, выключатель и hedged-запросы против локальной заглушки (fake_openai.py)
+# с внедрёнными отказами: доля успешных ответов и задержка при разных режимах.
+#
+#   python benchmarks/bench_openai_resilience.py --requests 200 --error-rate 0.3
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common  # noqa: E402
+
+PORT = 8099
+os.environ.setdefault("OPENAI_BASE_URL", f"http://127.0.0.1:{PORT}/v1")
+os.environ.setdefault("OPENAI_BACKOFF_BASE", "0.05")
+os.environ.setdefault("OPENAI_BACKOFF_MAX", "0.5")
+os.environ.setdefault("OPENAI_BREAKER_COOLDOWN", "1")
+os.environ.setdefault("OPENAI_HEDGE", "1")
+os.environ.setdefault("OPENAI_HEDGE_MIN_DELAY", "0.05")
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from fake_openai import Faults, create_app  # noqa: E402
+from metrics import REGISTRY  # noqa: E402
+from openai_utils import analyze_text_with_openai, breaker_stats  # noqa: E402
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+async def run_scenario(name, faults, requests, concurrency):
+    app = create_app(faults)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    ok = 0
+
+    async with aiohttp.ClientSession() as session:
+        async def one(i):
+            nonlocal ok
+            async with semaphore:
+                started = time.perf_counter()
+                if await analyze_text_with_openai(session, f"вопрос {i}"):
+                    ok += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - started
+    await runner.cleanup()
+
+    print(f"{name:<24} ok {ok:>4}/{requests}  upstream calls {faults.requests:>4}  "
+          f"p50 {percentile(latencies, 0.5) * 1000:7.1f} ms  p99 {percentile(latencies, 0.99) * 1000:7.1f} ms  "
+          f"total {elapsed:5.1f} s  breaker {breaker_stats().get('openai', {}).get('state')}")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.3)
+    args = parser.parse_args()
+    common.quiet_logging(logging.CRITICAL)
+
+    await run_scenario("healthy", Faults(latency=0.01, seed=1), args.requests, args.concurrency)
+    await run_scenario("5% slow, hedged", Faults(latency=0.01, slow_rate=0.05, slow_latency=1.0, seed=1),
+                       args.requests, args.concurrency)
+    await run_scenario(f"{args.error_rate:.0%} 503", Faults(error_rate=args.error_rate, latency=0.01, seed=1),
+                       args.requests, args.concurrency)
+    await run_scenario("10% 429 + Retry-After", Faults(rate_limit_rate=0.1, retry_after=0, latency=0.01, seed=1),
+                       args.requests, args.concurrency)
+    await run_scenario("upstream down", Faults(error_rate=1.0, seed=1), args.requests, args.concurrency)
+    # После cooldown выключатель пропускает один пробный запрос и закрывается
+    await asyncio.sleep(float(os.environ["OPENAI_BREAKER_COOLDOWN"]))
+    await run_scenario("half-open probe", Faults(latency=0.01, seed=1), 1, 1)
+    await run_scenario("recovered", Faults(latency=0.01, seed=1), args.requests, args.concurrency)
+
+    for line in REGISTRY.render().splitlines():
+        if line.startswith(("recipe_upstream_retries_total{", "recipe_upstream_hedges_total{")):
+            print(line)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+# Очередь к OpenAI в пределах лимита TPM: всплеск запросов одного клиента
+# не должен задерживать других клиентов и фоновый рецепт дня дольше своей доли.
+#
+# Ведро TPM вначале полное, поэтому всплеск должен быть больше его ёмкости
+# (~4400 токенов на текстовый запрос, в основном max_tokens).
+#
+#   python benchmarks/bench_upstream_budget.py --tpm 1200000 --burst 300
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common  # noqa: E402
+
+PORT = 8099
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--tpm", type=int, default=1200000)
+parser.add_argument("--burst", type=int, default=300)
+args = parser.parse_args()
+
+# Лимиты читаются из окружения при импорте config
+os.environ.setdefault("OPENAI_BASE_URL", f"http://127.0.0.1:{PORT}/v1")
+os.environ.setdefault("OPENAI_TPM", str(args.tpm))
+os.environ.setdefault("OPENAI_BACKGROUND_MAX_WAIT", "2")
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+from budget import current_client  # noqa: E402
+from fake_openai import Faults, create_app  # noqa: E402
+from openai_utils import analyze_text_with_openai, budget_stats, fetch_daily_recipe  # noqa: E402
+
+async def main():
+    common.quiet_logging(logging.CRITICAL)
+
+    faults = Faults(latency=0.05, tpm=args.tpm, seed=1)
+    runner = web.AppRunner(create_app(faults))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    finished = {}
+
+    async with aiohttp.ClientSession() as session:
+        async def interactive(client, i):
+            current_client.set(client)
+            started = time.perf_counter()
+            await analyze_text_with_openai(session, f"{client} вопрос {i}")
+            finished.setdefault(client, []).append(time.perf_counter() - started)
+
+        async def background():
+            started = time.perf_counter()
+            await fetch_daily_recipe(session)
+            finished.setdefault("background", []).append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(interactive("10.0.0.1", i)) for i in range(args.burst)]
+        await asyncio.sleep(0.5)
+        tasks.append(asyncio.create_task(background()))
+        tasks += [asyncio.create_task(interactive("10.0.0.2", i)) for i in range(3)]
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    await runner.cleanup()
+
+    print(f"TPM {args.tpm}, {args.burst} requests from 10.0.0.1, 3 from 10.0.0.2, 1 background; total {elapsed:.1f} s")
+    for name, latencies in finished.items():
+        print(f"  {name:<12} n={len(latencies):>3}  mean {sum(latencies) / len(latencies):6.2f} s  max {max(latencies):6.2f} s")
+    print(f"  upstream 429s: {faults.rate_limited}, budget: {budget_stats()['openai']}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+import logging
+import os
+import random
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+# config.py требует эти переменные; для бенчмарков реальные значения не нужны
+for name, value in {
+    "OPENAI_API_KEY": "benchmark",
+    "DB_USER": "benchmark",
+    "DB_PASSWORD": "benchmark",
+    "DB_NAME": "benchmark",
+    "DB_HOST": "127.0.0.1",
+}.items():
+    os.environ.setdefault(name, value)
+
+def quiet_logging(level=logging.WARNING):
+    import config  # noqa: F401  (настраивает корневой логгер)
+    logging.getLogger().setLevel(level)
+
+# Размеры "фото с телефона": мегапиксели -> (ширина, высота) при 4:3
+PHOTO_SIZES = {
+    1: (1152, 864),
+    12: (4000, 3000),
+    24: (5664, 4248),
+    48: (8000, 6000),
+}
+
+def synthetic_photo(width, height, seed=0):
+    # Градиент + шум + пятна: сжимается примерно как настоящее фото,
+    # в отличие от однотонной картинки
+    from PIL import Image, ImageDraw, ImageFilter
+
+    rng = random.Random(seed)
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width // 4, height // 4), 40).resize((width, height))
+    image = Image.merge("RGB", (base, noise, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randrange(width // 40, width // 8)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    return image.filter(ImageFilter.GaussianBlur(2))
+
+# Фото iPhone после конвертации HEIC -> JPEG на телефоне: EXIF, ICC-профиль, 4:2:0.
+# С pillow-heif картинка сначала действительно проходит через HEIC.
+def save_heic_converted(image, path):
+    import io
+    from PIL import Image
+
+    try:
+        import pillow_heif
+    except ImportError:
+        pillow_heif = None
+    if pillow_heif is not None:
+        pillow_heif.register_heif_opener()
+        buffer = io.BytesIO()
+        image.save(buffer, format="HEIF", quality=90)
+        buffer.seek(0)
+        image = Image.open(buffer).convert("RGB")
+
+    exif = Image.Exif()
+    exif[0x010F] = "Apple"  # Make
+    exif[0x0110] = "iPhone"  # Model
+    exif[0x0112] = 1  # Orientation
+    options = {"quality": 90, "subsampling": "4:2:0", "exif": exif.tobytes()}
+    try:
+        from PIL import ImageCms
+        options["icc_profile"] = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    except ImportError:
+        pass
+    image.save(path, format="JPEG", **options)
+
+def build_corpus(directory, sizes=(1, 12, 24, 48), formats=("JPEG", "PNG")):
+    # Создаёт (или переиспользует) набор синтетических фото и возвращает пути.
+    # Формат "HEIC" — JPEG, сконвертированный из HEIC (см. save_heic_converted).
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for megapixels in sizes:
+        width, height = PHOTO_SIZES[megapixels]
+        for fmt in formats:
+            name = {"JPEG": "jpg", "HEIC": "heic.jpg"}.get(fmt, fmt.lower())
+            path = os.path.join(directory, f"synthetic_{megapixels}mp.{name}")
+            if not os.path.exists(path):
+                image = synthetic_photo(width, height, seed=megapixels)
+                if fmt == "HEIC":
+                    save_heic_converted(image, path)
+                else:
+                    options = {"quality": 92} if fmt == "JPEG" else {}
+                    image.save(path, format=fmt, **options)
+            paths.append(path)
+    return paths
+
+def load_corpus(directory):
+    exts = (".jpg", ".jpeg", ".png", ".webp", ".heic")
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.lower().endswith(exts)
+    )
@@ -0,0 +1,263 @@
+# Локальная заглушка OpenAI API с внедрением отказов: проверка повторов,
+# выключателя и hedged-запросов без обращения к настоящему API.
+#
+#   python benchmarks/fake_openai.py --port 8099 --error-rate 0.3 --rate-limit-rate 0.1
+#   OPENAI_BASE_URL=http://127.0.0.1:8099/v1 python server.py
+#
+# Режим отказов меняется на лету: POST /_faults {"error_rate": 1.0} — "упавший" upstream.
+# --rpm/--tpm включают лимиты аккаунта с заголовками x-ratelimit-* и 429 при превышении.
+# Задержка до ответа — --latency с распределением --latency-dist (fixed, uniform,
+# exponential, lognormal с медианой --latency и разбросом --latency-sigma); стрим отдаётся
+# кусками по --chunk-delay, расшифровка дольше на --audio-latency-per-mb.
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from aiohttp import web
+
+RECIPE = {
+    "title": "Тестовое блюдо",
+    "intro": "Ответ локальной заглушки OpenAI",
+    "ingredients": "• вода\n• соль",
+    "recipe": "1. Смешать\n2. Подать",
+    "proteins": 1,
+    "fats": 2,
+    "carbs": 3,
+    "calories": 30,
+}
+
+class RateLimit:
+    # Лимит в минуту, как у OpenAI: ведро восстанавливается равномерно,
+    # остаток и время до полного восстановления уходят в x-ratelimit-*
+    def __init__(self, limit):
+        self.limit = limit
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def take(self, amount):
+        self._refill()
+        if self.level < amount:
+            return False
+        self.level -= amount
+        return True
+
+    def wait(self, amount):
+        return max(0.0, (amount - self.level) * 60 / self.limit)
+
+    def reset(self):
+        return f"{(self.limit - self.level) * 60 / self.limit:.3f}s"
+
+# Оценка токенов, которую лимитер OpenAI списывает при приёме запроса
+def estimate_tokens(payload):
+    tokens = payload.get("max_tokens", 0)
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // 4 + 1
+            elif part.get("type") == "image_url":
+                tokens += 255
+    return tokens
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+class Faults:
+    def __init__(self, error_rate=0.0, error_status=503, rate_limit_rate=0.0, retry_after=1,
+                 latency=0.0, slow_rate=0.0, slow_latency=5.0, rpm=0, tpm=0, seed=None,
+                 latency_dist="fixed", latency_sigma=0.5, chunk_delay=0.0, audio_latency_per_mb=0.0):
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.chunk_delay = chunk_delay
+        self.audio_latency_per_mb = audio_latency_per_mb
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.rpm = RateLimit(rpm) if rpm else None
+        self.tpm = RateLimit(tpm) if tpm else None
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    def update(self, values):
+        for key, value in values.items():
+            if key in ("error_rate", "rate_limit_rate", "latency", "slow_rate", "slow_latency",
+                       "latency_sigma", "chunk_delay", "audio_latency_per_mb"):
+                setattr(self, key, float(value))
+            elif key in ("error_status", "retry_after"):
+                setattr(self, key, int(value))
+            elif key == "latency_dist" and value in LATENCY_DISTRIBUTIONS:
+                self.latency_dist = value
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "error_rate": self.error_rate,
+            "rate_limit_rate": self.rate_limit_rate,
+            "slow_rate": self.slow_rate,
+            "latency": self.latency,
+            "latency_dist": self.latency_dist,
+        }
+
+    # Задержка очередного ответа; latency — среднее (для lognormal — медиана)
+    def sample_latency(self):
+        if self.slow_rate and self.random.random() < self.slow_rate:
+            return self.slow_latency
+        if not self.latency:
+            return 0.0
+        if self.latency_dist == "uniform":
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_dist == "exponential":
+            return self.random.expovariate(1 / self.latency)
+        if self.latency_dist == "lognormal":
+            return self.random.lognormvariate(math.log(self.latency), self.latency_sigma)
+        return self.latency
+
+    def _ratelimit_headers(self):
+        headers = {}
+        for kind, limit in (("requests", self.rpm), ("tokens", self.tpm)):
+            if limit is not None:
+                headers[f"x-ratelimit-limit-{kind}"] = str(limit.limit)
+                headers[f"x-ratelimit-remaining-{kind}"] = str(int(limit.level))
+                headers[f"x-ratelimit-reset-{kind}"] = limit.reset()
+        return headers
+
+    # Проверка лимитов RPM/TPM: 429 с Retry-After, если бюджета нет
+    def _check_limits(self, tokens):
+        for limit, amount in ((self.rpm, 1), (self.tpm, tokens)):
+            if limit is not None and not limit.take(amount):
+                self.rate_limited += 1
+                headers = self._ratelimit_headers()
+                headers["Retry-After"] = str(math.ceil(limit.wait(amount)))
+                return web.json_response(
+                    {"error": {"message": "Rate limit reached", "type": "requests"}},
+                    status=429,
+                    headers=headers
+                )
+        return None
+
+    # Задержка и, возможно, ответ с ошибкой для очередного запроса.
+    # Возвращает (ответ с ошибкой или None, заголовки x-ratelimit-* для успешного ответа).
+    async def inject(self, tokens=0, extra_latency=0.0):
+        self.requests += 1
+        limited = self._check_limits(tokens)
+        if limited is not None:
+            return limited, None
+        delay = self.sample_latency() + extra_latency
+        if delay:
+            await asyncio.sleep(delay)
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.failed += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)}
+            ), None
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.failed += 1
+            return web.json_response(
+                {"error": {"message": "Injected failure", "type": "server_error"}},
+                status=self.error_status
+            ), None
+        return None, self._ratelimit_headers()
+
+async def handle_chat(request):
+    payload = await request.json()
+    estimated = estimate_tokens(payload)
+    failure, headers = await request.app['faults'].inject(estimated)
+    if failure is not None:
+        return failure
+    content = json.dumps(RECIPE, ensure_ascii=False)
+    if not payload.get("stream"):
+        usage = estimated - payload.get("max_tokens", 0) + len(content) // 4
+        return web.json_response({
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"total_tokens": usage},
+        }, headers=headers)
+
+    headers["Content-Type"] = "text/event-stream"
+    response = web.StreamResponse(headers=headers)
+    await response.prepare(request)
+    chunk_delay = request.app['faults'].chunk_delay
+    for start in range(0, len(content), 16):
+        if chunk_delay and start:
+            await asyncio.sleep(chunk_delay)
+        chunk = {"choices": [{"index": 0, "delta": {"content": content[start:start + 16]}}]}
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+async def handle_transcription(request):
+    # Тело дочитываем полностью, как настоящий API
+    faults = request.app['faults']
+    reader = await request.multipart()
+    size = 0
+    async for part in reader:
+        while chunk := await part.read_chunk():
+            size += len(chunk)
+    failure, headers = await faults.inject(extra_latency=faults.audio_latency_per_mb * size / (1024 * 1024))
+    if failure is not None:
+        return failure
+    return web.json_response({"text": "Как приготовить борщ?"}, headers=headers)
+
+async def handle_faults(request):
+    faults = request.app['faults']
+    if request.method == "POST":
+        faults.update(await request.json())
+    return web.json_response(faults.stats())
+
+def create_app(faults=None):
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app['faults'] = faults or Faults()
+    app.router.add_post("/v1/chat/completions", handle_chat)
+    app.router.add_post("/v1/audio/transcriptions", handle_transcription)
+    app.router.add_get("/_faults", handle_faults)
+    app.router.add_post("/_faults", handle_faults)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="fake OpenAI API with fault injection, rate limits and latency models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the response (mean)")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal shape")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--audio-latency-per-mb", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-latency", type=float, default=5.0)
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute limit, 0 = unlimited")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute limit, 0 = unlimited")
+    args = parser.parse_args()
+    faults = Faults(
+        error_rate=args.error_rate, error_status=args.error_status,
+        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after,
+        latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+        rpm=args.rpm, tpm=args.tpm, latency_dist=args.latency_dist, latency_sigma=args.latency_sigma,
+        chunk_delay=args.chunk_delay, audio_latency_per_mb=args.audio_latency_per_mb
+    )
+    web.run_app(create_app(faults), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
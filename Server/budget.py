@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+
+# Классы приоритета: запросы пользователей раньше фоновых задач
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Клиент (IP), от имени которого идёт запрос к OpenAI; None — фоновая задача.
+# Выставляет admission_middleware.
+current_client = contextvars.ContextVar("upstream_client", default=None)
+
+def _header_int(headers, name):
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+class _Bucket:
+    # Ведро лимита в минуту (запросов или токенов). limit=0 — лимит неизвестен,
+    # ограничения нет, пока его не сообщат заголовки ответа.
+
+    def __init__(self, limit, clock):
+        self.limit = limit
+        self.level = float(limit)
+        self.rate = limit / 60
+        self._clock = clock
+        self.updated = clock()
+
+    def _refill(self, now):
+        if self.limit:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        if not self.limit:
+            return 0.0
+        self._refill(now)
+        # Запрос больше всего лимита ждёт полного ведра, а не вечно
+        amount = min(amount, self.limit)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if self.limit:
+            self.level -= min(amount, self.limit)
+
+    def give_back(self, amount):
+        if self.limit:
+            self.level = min(self.limit, self.level + amount)
+
+    # Лимит из заголовков. Остаток в ответе не учитывает запросы, отправленные
+    # после него, поэтому он может только уменьшить локальную оценку.
+    def sync(self, limit, remaining):
+        if limit and limit != self.limit:
+            if not self.limit:
+                self.level = float(limit)
+            self.limit = limit
+            self.rate = limit / 60
+        if not self.limit:
+            return
+        self._refill(self._clock())
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+
+class UpstreamBudget:
+    # Допуск запросов к OpenAI в пределах лимитов аккаунта (RPM/TPM).
+    # Очередь — взвешенная справедливая (virtual finish time по оценке токенов)
+    # между клиентами внутри класса приоритета; фоновые запросы идут после
+    # интерактивных, но не дольше background_max_wait в очереди.
+
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, background_max_wait=30.0,
+                 clock=time.monotonic):
+        self.name = name
+        self.requests = _Bucket(requests_per_minute, clock)
+        self.tokens = _Bucket(tokens_per_minute, clock)
+        self.background_max_wait = background_max_wait
+        self._clock = clock
+        self._queues = ([], [])
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._finish = {}
+        self._paused_until = 0.0
+        self._timer = None
+        self.admitted = 0
+        self.waited = 0
+        self.rate_limited = 0
+
+    @property
+    def queued(self):
+        return sum(1 for queue in self._queues for entry in queue if not entry[-1].done())
+
+    def _wait_time(self, cost, now):
+        return max(
+            self._paused_until - now,
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(cost, now),
+        )
+
+    def _take(self, cost):
+        self.requests.take(1)
+        self.tokens.take(cost)
+        self.admitted += 1
+
+    async def acquire(self, cost, priority=INTERACTIVE, client=None):
+        now = self._clock()
+        if not any(self._queues) and self._wait_time(cost, now) <= 0:
+            self._take(cost)
+            return
+
+        client = "background" if client is None else client
+        start = max(self._virtual_time, self._finish.get(client, 0.0))
+        tag = start + max(cost, 1)
+        self._finish[client] = tag
+        if len(self._finish) > 4096:
+            # Клиенты, давно отставшие от виртуального времени, больше ни на что не влияют
+            self._finish = {key: value for key, value in self._finish.items() if value > self._virtual_time}
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queues[priority], (tag, next(self._seq), cost, now, future))
+        self.waited += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Допуск выдан, но запрос уже не нужен — возвращаем бюджет
+                self.refund(cost)
+            self._dispatch()
+            raise
+
+    def refund(self, cost):
+        self.requests.give_back(1)
+        self.tokens.give_back(cost)
+
+    # Следующий в очереди: фоновый, если ждёт слишком долго, иначе интерактивный
+    def _head(self, now):
+        for queue in self._queues:
+            while queue and queue[0][-1].done():
+                heapq.heappop(queue)
+        interactive, background = self._queues
+        if background and (not interactive or now - background[0][3] >= self.background_max_wait):
+            return background
+        return interactive or None
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = self._clock()
+        while True:
+            queue = self._head(now)
+            if queue is None:
+                return
+            tag, _, cost, _, future = queue[0]
+            wait = self._wait_time(cost, now)
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(queue)
+            self._virtual_time = tag
+            self._take(cost)
+            future.set_result(None)
+
+    # Учёт ответа: лимиты из x-ratelimit-*, а без них — фактический расход токенов
+    def settle(self, headers, estimated, used=None):
+        token_limit = _header_int(headers, "x-ratelimit-limit-tokens")
+        remaining_tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+        self.requests.sync(
+            _header_int(headers, "x-ratelimit-limit-requests"),
+            _header_int(headers, "x-ratelimit-remaining-requests")
+        )
+        self.tokens.sync(token_limit, remaining_tokens)
+        if remaining_tokens is None and used is not None and used < estimated:
+            self.tokens.give_back(estimated - used)
+        if any(self._queues):
+            self._dispatch()
+
+    # 429: никого не пускаем, пока upstream не разрешит
+    def pause(self, seconds):
+        self.rate_limited += 1
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    def stats(self):
+        return {
+            "requests_limit": self.requests.limit,
+            "requests_available": int(self.requests.level),
+            "tokens_limit": self.tokens.limit,
+            "tokens_available": int(self.tokens.level),
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "waited": self.waited,
+            "rate_limited": self.rate_limited,
+        }
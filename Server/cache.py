@@ -0,0 +1,232 @@
+import re
+import time
+from array import array
+from collections import OrderedDict
+
+# Всё, что не буква/цифра/пробел — пунктуация, её выбрасываем при нормализации
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+", re.UNICODE)
+
+def normalize_text(text):
+    # "  Борщ,  РЕЦЕПТ!! " -> "борщ рецепт"
+    text = text.casefold().replace("_", " ")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACES_RE.sub(" ", text).strip()
+
+class TTLCache:
+    # Ограниченный LRU-кэш с временем жизни записей.
+    # Работает внутри event loop, поэтому блокировки не нужны.
+
+    def __init__(self, max_size=10000, ttl=24 * 60 * 60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and entry[1] > self._clock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= self._clock():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        if key in self._data:
+            self._data.move_to_end(key)
+        self._data[key] = (value, expires_at)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+def _popcount(x):
+    return bin(x).count("1")
+
+def _chunk_variants(bits, radius):
+    # Все маски длины bits с не более чем radius единицами
+    masks = [0]
+    frontier = [(0, -1)]
+    for _ in range(radius):
+        next_frontier = []
+        for mask, last in frontier:
+            for bit in range(last + 1, bits):
+                new_mask = mask | (1 << bit)
+                masks.append(new_mask)
+                next_frontier.append((new_mask, bit))
+        frontier = next_frontier
+    return masks
+
+class PerceptualHashIndex:
+    # LRU+TTL-хранилище ответов по 64-битным перцептивным хэшам с поиском
+    # ближайшего соседа по расстоянию Хэмминга.
+    # Индекс — multi-index hashing: хэш режется на chunks кусков, и если
+    # расстояние <= max_distance, то хотя бы один кусок отличается не более
+    # чем на max_distance // chunks бит. Поэтому кандидатов ищем точным
+    # совпадением кусков с перебором малого числа вариантов, а не полным
+    # перебором всех записей.
+    # Корзины индекса — упакованные массивы uint64 с самими хэшами, а не множества
+    # ключей: на миллион записей ~70 МБ вместо ~270 МБ.
+
+    HASH_BITS = 64
+
+    def __init__(self, max_size=100000, ttl=24 * 60 * 60, max_distance=4, chunks=4, clock=time.monotonic):
+        if self.HASH_BITS % chunks:
+            raise ValueError("chunks must divide 64")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.chunks = chunks
+        self._chunk_bits = self.HASH_BITS // chunks
+        self._chunk_mask = (1 << self._chunk_bits) - 1
+        self._variants = {}
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._buckets = [{} for _ in range(chunks)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _split(self, image_hash):
+        return [
+            (image_hash >> (i * self._chunk_bits)) & self._chunk_mask
+            for i in range(self.chunks)
+        ]
+
+    def _masks(self, max_distance):
+        radius = max_distance // self.chunks
+        masks = self._variants.get(radius)
+        if masks is None:
+            masks = _chunk_variants(self._chunk_bits, radius)
+            self._variants[radius] = masks
+        return masks
+
+    def _remove(self, key):
+        del self._entries[key]
+        for i, part in enumerate(self._split(key[0])):
+            bucket = self._buckets[i].get(part)
+            if bucket is None:
+                continue
+            # Одинаковый хэш с разными tag лежит в корзине по разу на ключ
+            bucket.remove(key[0])
+            if not bucket:
+                del self._buckets[i][part]
+
+    def get(self, image_hash, tag="", max_distance=None):
+        # Возвращает (значение, расстояние) ближайшей записи или (None, None)
+        if max_distance is None:
+            max_distance = self.max_distance
+        now = self._clock()
+        best_key = None
+        best_distance = max_distance + 1
+        expired = []
+        masks = self._masks(max_distance)
+        for i, part in enumerate(self._split(image_hash)):
+            buckets = self._buckets[i]
+            for mask in masks:
+                bucket = buckets.get(part ^ mask)
+                if not bucket:
+                    continue
+                for candidate in bucket:
+                    distance = _popcount(candidate ^ image_hash)
+                    if distance >= best_distance:
+                        continue
+                    key = (candidate, tag)
+                    entry = self._entries.get(key)
+                    if entry is None:
+                        continue
+                    if entry[1] <= now:
+                        expired.append(key)
+                        continue
+                    best_key = key
+                    best_distance = distance
+            if best_distance == 0:
+                break
+
+        for key in set(expired):
+            if key in self._entries:
+                self._remove(key)
+                self.expirations += 1
+
+        if best_key is None:
+            self.misses += 1
+            return None, None
+        self._entries.move_to_end(best_key)
+        self.hits += 1
+        return self._entries[best_key][0], best_distance
+
+    def set(self, image_hash, value, tag="", ttl=None):
+        key = (image_hash, tag)
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        else:
+            for i, part in enumerate(self._split(image_hash)):
+                bucket = self._buckets[i].get(part)
+                if bucket is None:
+                    bucket = self._buckets[i][part] = array("Q")
+                bucket.append(image_hash)
+        self._entries[key] = (value, expires_at)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._buckets = [{} for _ in range(self.chunks)]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "max_distance": self.max_distance,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -1,10 +1,73 @@
+import atexit
+import contextvars
+import hashlib
 import os
+import queue
+import time
 from dotenv import load_dotenv
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 # Загрузка переменных окружения
 load_dotenv()
 
+# Id текущего запроса; выставляется tracing_middleware и попадает в каждую строку лога
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+# Не больше LOG_RATE_LIMIT INFO-строк за LOG_RATE_INTERVAL секунд с одного места
+# в коде; WARNING и выше проходят всегда
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate, interval):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.suppressed = 0
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            skipped = window[2] if window else 0
+            self._windows[key] = [now, 1, 0]
+            if skipped:
+                record.msg = f"{record.getMessage()} ({skipped} similar messages suppressed)"
+                record.args = None
+            return True
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+        window[2] += 1
+        self.suppressed += 1
+        return False
+
+# QueueHandler с ограниченной очередью: при переполнении запись теряется
+# (и считается), а не блокирует event loop
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_INTERVAL = float(os.getenv("LOG_RATE_INTERVAL", "1"))
+LOG_PAYLOAD_LIMIT = int(os.getenv("LOG_PAYLOAD_LIMIT", "200"))
+
 # Настройка логирования
 root_logger = logging.getLogger()
 root_logger.setLevel(logging.INFO)
@@ -12,16 +75,46 @@ root_logger.setLevel(logging.INFO)
 # Обработчик для файла (только ERROR и выше)
 file_handler = logging.FileHandler("server.log")
 file_handler.setLevel(logging.ERROR)
-file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 
 # Обработчик для консоли (INFO и выше)
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+# В корневой логгер — только постановка в очередь; в файл и консоль пишет
+# фоновый поток QueueListener. Id запроса берётся здесь, в потоке запроса.
+queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+queue_handler.addFilter(RequestIdFilter())
+rate_limit_filter = RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_INTERVAL)
+queue_handler.addFilter(rate_limit_filter)
+root_logger.addHandler(queue_handler)
 
-# Добавляем обработчики в корневой логгер
-root_logger.addHandler(file_handler)
-root_logger.addHandler(console_handler)
+log_listener = QueueListener(queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Процессы пула сжатия фото создаются через fork, а поток QueueListener в них не
+# копируется: записи из очереди никто бы не прочитал. Там пишем в файл и консоль
+# напрямую, не трогая очередь (её lock мог быть захвачен в момент fork).
+# Id запроса, во время которого случился fork, к воркеру не относится — сбрасываем.
+def configure_worker_logging():
+    request_id_var.set("-")
+    root_logger.removeHandler(queue_handler)
+    request_id_filter = RequestIdFilter()
+    for handler in (file_handler, console_handler):
+        handler.addFilter(request_id_filter)
+        root_logger.addHandler(handler)
+
+# Большие тексты (ответы OpenAI, расшифровки) в лог — только начало и хэш
+def truncate_payload(text, limit=LOG_PAYLOAD_LIMIT):
+    if text is None:
+        return "None"
+    text = str(text)
+    if len(text) <= limit:
+        return text
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+    return f"{text[:limit]}... [{len(text)} chars, sha256 {digest}]"
 
 # Получаем логгер для текущего модуля
 logger = logging.getLogger(__name__)
@@ -33,6 +126,153 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
 DB_HOST = os.getenv("DB_HOST")
 
+# Запуск: адрес, число процессов-воркеров (0 — по числу ядер; делят порт через
+# SO_REUSEPORT, см. runner.py), uvloop (если установлен), сколько ждать завершения
+# запросов при остановке воркера и сколько ждать готовности нового воркера
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1")) or os.cpu_count() or 1
+SERVER_UVLOOP = os.getenv("SERVER_UVLOOP", "1") == "1"
+SERVER_SHUTDOWN_TIMEOUT = float(os.getenv("SERVER_SHUTDOWN_TIMEOUT", "30"))
+SERVER_READY_TIMEOUT = float(os.getenv("SERVER_READY_TIMEOUT", "60"))
+
+# Пул соединений с Postgres на процесс: не больше DB_POOL_MAX_SIZE и не больше
+# (max_connections - superuser_reserved_connections - DB_RESERVED_CONNECTIONS) / SERVER_WORKERS,
+# чтобы все воркеры вместе не упёрлись в лимит сервера БД
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "100"))
+DB_RESERVED_CONNECTIONS = int(os.getenv("DB_RESERVED_CONNECTIONS", "10"))
+
+# Запросы к OpenAI: адрес API (можно направить на локальную заглушку), таймаут попытки,
+# повторы при 429/5xx с экспоненциальной задержкой, выключатель и hedged-запросы
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+OPENAI_MAX_RETRY_WAIT = float(os.getenv("OPENAI_MAX_RETRY_WAIT", "20"))
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "0") == "1"
+OPENAI_HEDGE_QUANTILE = float(os.getenv("OPENAI_HEDGE_QUANTILE", "0.95"))
+OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "2"))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+
+# Лимиты аккаунта OpenAI в минуту (0 — узнать из заголовков x-ratelimit-*),
+# сколько фоновая задача ждёт за интерактивными и сколько ждёт пользователь.
+# UPSTREAM_CLIENT_HEADER — заголовок с IP клиента за прокси (например, X-Real-IP).
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))
+WHISPER_RPM = int(os.getenv("WHISPER_RPM", "0"))
+OPENAI_BACKGROUND_MAX_WAIT = float(os.getenv("OPENAI_BACKGROUND_MAX_WAIT", "30"))
+OPENAI_BUDGET_MAX_WAIT = float(os.getenv("OPENAI_BUDGET_MAX_WAIT", "30"))
+UPSTREAM_CLIENT_HEADER = os.getenv("UPSTREAM_CLIENT_HEADER", "")
+
+# Кэш ответов на текстовые вопросы
+TEXT_CACHE_MAX_SIZE = int(os.getenv("TEXT_CACHE_MAX_SIZE", "10000"))
+TEXT_CACHE_TTL = int(os.getenv("TEXT_CACHE_TTL", str(24 * 60 * 60)))
+
+# Кэш анализа фото по перцептивному хэшу. Индекс занимает ~300 байт на запись
+# без самих рецептов (100000 — ~30 МБ, миллион — ~300 МБ) в каждом воркере
+IMAGE_CACHE_MAX_SIZE = int(os.getenv("IMAGE_CACHE_MAX_SIZE", "100000"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(24 * 60 * 60)))
+IMAGE_HASH_MAX_DISTANCE = int(os.getenv("IMAGE_HASH_MAX_DISTANCE", "4"))
+
+# Кэш расшифровок аудио по SHA-256 содержимого
+AUDIO_CACHE_MAX_SIZE = int(os.getenv("AUDIO_CACHE_MAX_SIZE", "10000"))
+AUDIO_CACHE_TTL = int(os.getenv("AUDIO_CACHE_TTL", str(24 * 60 * 60)))
+
+# Генерация рецепта дня при его отсутствии
+DAILY_RECIPE_WAIT_TIMEOUT = float(os.getenv("DAILY_RECIPE_WAIT_TIMEOUT", "30"))
+DAILY_RECIPE_LOCK_TIMEOUT = float(os.getenv("DAILY_RECIPE_LOCK_TIMEOUT", "60"))
+DAILY_RECIPE_RETRY_INTERVAL = float(os.getenv("DAILY_RECIPE_RETRY_INTERVAL", "60"))
+
+# Планировщик: смена рецепта дня каждый день в DAILY_RECIPE_ROTATE_AT ("ЧЧ:ММ",
+# локальное время сервера), при ошибке — повтор с экспоненциальной задержкой
+# от DAILY_RECIPE_RETRY_INTERVAL до DAILY_RECIPE_RETRY_MAX. Фоновые задачи выполняет
+# один процесс кластера (лидер по advisory-lock); остальные раз в
+# DAILY_RECIPE_REFRESH_INTERVAL подхватывают новый рецепт из БД.
+def _parse_clock(value):
+    hour, minute = value.split(":")
+    return int(hour), int(minute)
+
+DAILY_RECIPE_ROTATE_AT = _parse_clock(os.getenv("DAILY_RECIPE_ROTATE_AT", "00:00"))
+DAILY_RECIPE_RETRY_MAX = float(os.getenv("DAILY_RECIPE_RETRY_MAX", str(60 * 60)))
+DAILY_RECIPE_REFRESH_INTERVAL = float(os.getenv("DAILY_RECIPE_REFRESH_INTERVAL", "60"))
+SCHEDULER_HEARTBEAT = float(os.getenv("SCHEDULER_HEARTBEAT", "30"))
+SCHEDULER_LEADER_RETRY = float(os.getenv("SCHEDULER_LEADER_RETRY", "30"))
+
+# Размер страницы истории рецептов дня (GET /daily_recipes)
+DAILY_RECIPES_PAGE_SIZE = int(os.getenv("DAILY_RECIPES_PAGE_SIZE", "20"))
+DAILY_RECIPES_MAX_PAGE_SIZE = int(os.getenv("DAILY_RECIPES_MAX_PAGE_SIZE", "100"))
+
+# Очередь рецептов дня на DAILY_RECIPE_BUFFER_SIZE дней вперёд. Наполняется в часы
+# наименьшей нагрузки (локальное время сервера, "с-по", можно через полночь: "22-4")
+# не более чем DAILY_RECIPE_PREGEN_CONCURRENCY запросами одновременно.
+def _parse_hours(value):
+    start, end = value.split("-")
+    return int(start) % 24, int(end) % 24
+
+DAILY_RECIPE_BUFFER_SIZE = int(os.getenv("DAILY_RECIPE_BUFFER_SIZE", "7"))
+DAILY_RECIPE_PREGEN_CONCURRENCY = int(os.getenv("DAILY_RECIPE_PREGEN_CONCURRENCY", "3"))
+DAILY_RECIPE_OFFPEAK_HOURS = _parse_hours(os.getenv("DAILY_RECIPE_OFFPEAK_HOURS", "2-6"))
+DAILY_RECIPE_PREGEN_INTERVAL = float(os.getenv("DAILY_RECIPE_PREGEN_INTERVAL", str(15 * 60)))
+# Сколько последних рецептов дня из истории не повторять при наполнении очереди
+DAILY_RECIPE_RECENT_TITLES = int(os.getenv("DAILY_RECIPE_RECENT_TITLES", "60"))
+
+# Приём файлов: до UPLOAD_SPOOL_MAX_MEMORY держим в памяти, больше — во временном файле.
+# UPLOAD_MAX_SIZE — лимит тела запроса и каждого файла (больше — 413)
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", str(10 * 1024 * 1024)))
+UPLOAD_SPOOL_MAX_MEMORY = int(os.getenv("UPLOAD_SPOOL_MAX_MEMORY", str(1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(64 * 1024)))
+# Аудио отдаётся в Whisper по мере загрузки клиентом, не дожидаясь конца запроса.
+# Кэш расшифровок при этом только пополняется: хэш файла известен лишь в конце.
+# Медленная загрузка клиента входит в OPENAI_TIMEOUT первой попытки.
+AUDIO_PASSTHROUGH = os.getenv("AUDIO_PASSTHROUGH", "0") == "1"
+
+# Сжатие фото перед отправкой в OpenAI
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "512"))
+IMAGE_FAST_DECODE = os.getenv("IMAGE_FAST_DECODE", "1") == "1"
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+# Пул процессов для сжатия фото (0 — по числу ядер), длина очереди к нему и сколько
+# секунд ждать сжатия одного фото
+IMAGE_POOL_WORKERS = int(os.getenv("IMAGE_POOL_WORKERS", "0"))
+IMAGE_POOL_MAX_PENDING = int(os.getenv("IMAGE_POOL_MAX_PENDING", "0"))
+IMAGE_POOL_RETRY_AFTER = int(os.getenv("IMAGE_POOL_RETRY_AFTER", "2"))
+IMAGE_POOL_TIMEOUT = float(os.getenv("IMAGE_POOL_TIMEOUT", "30"))
+
+# Контроль допуска: маршрут -> (одновременных запросов, длина очереди, секунд в очереди).
+# Переопределяется через ADMISSION_LIMITS="/upload=32:64:10,/upload_text=64:128:5"
+def _parse_admission_limits(value):
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        path, spec = item.split("=")
+        limit, max_queue, queue_timeout = spec.split(":")
+        limits[path.strip()] = (int(limit), int(max_queue), float(queue_timeout))
+    return limits
+
+ADMISSION_LIMITS = {
+    "/upload": (32, 64, 10.0),
+    "/upload_audio": (16, 32, 10.0),
+    "/upload_audio_stream": (16, 32, 10.0),
+    "/upload_text": (64, 128, 5.0),
+    "/upload_text_stream": (64, 128, 5.0),
+}
+ADMISSION_LIMITS.update(_parse_admission_limits(os.getenv("ADMISSION_LIMITS", "")))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+
+# Трассировка: куда выгружать ("jsonl", "otlp" или пусто — выключено) и какие трассы
+# оставлять (tail-based: медленные, с ошибкой и случайная доля остальных)
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "jsonl")
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "traces.jsonl")
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL", "http://127.0.0.1:4318/v1/traces")
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "5"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "1000"))
+
 # Проверка конфигурации
 if not OPENAI_API_KEY:
     logger.error("OPENAI_API_KEY is not set in .env file")
@@ -0,0 +1,89 @@
+import gzip
+import hashlib
+import time
+from recipe import dumps, recipe_payload
+
+# Тело ответа, его gzip-версия и ETag
+def _encode(payload):
+    body = dumps(payload)
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    return body, gzip.compress(body, compresslevel=9), etag
+
+# ETag сжатого тела: у разных представлений ETag должен отличаться,
+# иначе кэш может отдать gzip клиенту, который его не принимает
+def gzip_etag(etag):
+    return etag[:-1] + '-gz"'
+
+# Принимает ли клиент gzip по Accept-Encoding с учётом q ("gzip;q=0" — не принимает)
+def accepts_gzip(accept_encoding):
+    wildcard = None
+    for item in (accept_encoding or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        coding = coding.lower()
+        if coding in ("gzip", "x-gzip"):
+            return quality > 0
+        if coding == "*":
+            wildcard = quality > 0
+    return bool(wildcard)
+
+class DailyRecipeCache:
+    # Рецепт дня в памяти в уже сериализованном (и сжатом) виде.
+    # Обновляется планировщиком раз в сутки, запросы не ходят в БД.
+    # Два варианта тела: старый (рецепт строкой) и typed (?v=2).
+
+    def __init__(self):
+        self.recipe = None
+        self.body = None
+        self.gzip_body = None
+        self.etag = None
+        self.typed_body = None
+        self.typed_gzip_body = None
+        self.typed_etag = None
+        self.updated_at = None
+        # Время (unix) следующего планового обновления, выставляет планировщик
+        self.next_update = None
+        # Плановое обновление не удалось — отдаём старый рецепт и пробуем снова
+        self.stale = False
+        self.last_attempt = None
+        # Сколько рецептов ждёт в очереди на следующие дни (None — ещё не проверяли)
+        self.buffered = None
+
+    def update(self, recipe):
+        self.recipe = recipe
+        self.body, self.gzip_body, self.etag = _encode(recipe_payload(recipe, False))
+        self.typed_body, self.typed_gzip_body, self.typed_etag = _encode(recipe_payload(recipe, True))
+        self.updated_at = time.time()
+        self.stale = False
+
+    def should_revalidate(self, interval):
+        if not self.stale:
+            return False
+        return self.last_attempt is None or time.time() - self.last_attempt >= interval
+
+    def max_age(self, default=60):
+        if self.next_update is None or self.stale:
+            return default
+        return max(0, int(self.next_update - time.time()))
+
+    # (тело, gzip-тело, ETag несжатого тела) для нужного формата ответа
+    def variant(self, typed):
+        if typed:
+            return self.typed_body, self.typed_gzip_body, self.typed_etag
+        return self.body, self.gzip_body, self.etag
+
+    def matches(self, if_none_match, etag):
+        if not if_none_match or etag is None:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag == etag or tag == "W/" + etag:
+                return True
+        return False
@@ -1,41 +1,255 @@
 import asyncpg
-from config import logger, DB_USER, DB_PASSWORD, DB_NAME, DB_HOST
+import contextlib
+import time
+from datetime import datetime, timedelta, timezone
+from config import (
+    logger, DB_USER, DB_PASSWORD, DB_NAME, DB_HOST,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_RESERVED_CONNECTIONS, SERVER_WORKERS
+)
+from metrics import STAGE_SECONDS, current_handler, stage
+from recipe import parse_recipe
+from tracing import start_span
+
+# Ключи advisory-lock: генерация рецепта дня и наполнение очереди рецептов (по одному на кластер)
+DAILY_RECIPE_LOCK_ID = 7316001
+DAILY_RECIPE_PREGEN_LOCK_ID = 7316002
+# Лидер фоновых задач: держит этот advisory-lock, пока жив его процесс
+SCHEDULER_LOCK_ID = 7316003
+
+# Размер пула на процесс: доля лимита соединений Postgres за вычетом резерва
+# суперпользователя и DB_RESERVED_CONNECTIONS (миграции, psql, другие сервисы).
+# Не меньше 4: лидер планировщика держит до трёх соединений под advisory-lock.
+async def pool_size(workers=SERVER_WORKERS):
+    connection = await asyncpg.connect(user=DB_USER, password=DB_PASSWORD, database=DB_NAME, host=DB_HOST)
+    try:
+        max_connections = int(await connection.fetchval("SHOW max_connections"))
+        superuser_reserved = int(await connection.fetchval("SHOW superuser_reserved_connections"))
+    finally:
+        await connection.close()
+    available = max_connections - superuser_reserved - DB_RESERVED_CONNECTIONS
+    max_size = max(4, min(DB_POOL_MAX_SIZE, available // workers))
+    if max_size * workers > available:
+        logger.warning(
+            f"Postgres max_connections={max_connections} is too low for {workers} workers, "
+            f"using {max_size} connections per worker anyway"
+        )
+    return min(DB_POOL_MIN_SIZE, max_size), max_size
 
 async def init_db_pool():
     logger.info("Initializing database pool...")
+    min_size, max_size = await pool_size()
+    logger.info(f"Database pool size: {min_size}-{max_size} connections per worker ({SERVER_WORKERS} workers)")
     pool = await asyncpg.create_pool(
         user=DB_USER,
         password=DB_PASSWORD,
         database=DB_NAME,
         host=DB_HOST,
-        min_size=5,
-        max_size=100,  # Увеличен размер пула
+        min_size=min_size,
+        max_size=max_size,
         command_timeout=60  # Таймаут для операций
     )
     logger.info("Database pool initialized")
     return pool
 
+# pool.acquire() с замером времени ожидания свободного соединения
+@contextlib.asynccontextmanager
+async def acquire(pool):
+    started = time.perf_counter()
+    acquire_span = start_span("db_acquire")
+    async with pool.acquire() as connection:
+        STAGE_SECONDS.observe(time.perf_counter() - started, current_handler.get(), "db_acquire")
+        if acquire_span is not None:
+            acquire_span.finish()
+        yield connection
+
 async def create_tables(pool):
     async with pool.acquire() as connection:
+        # История рецептов дня, только добавление; текущий — самый новый.
+        # Калорийность и БЖУ — генерируемые столбцы из JSONB для фильтров и отчётов.
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS daily_recipe_history (
+                id BIGSERIAL PRIMARY KEY,
+                recipe JSONB NOT NULL,
+                title TEXT GENERATED ALWAYS AS (recipe->>'title') STORED,
+                calories INTEGER GENERATED ALWAYS AS ((recipe->>'calories')::numeric::integer) STORED,
+                proteins REAL GENERATED ALWAYS AS ((recipe->>'proteins')::real) STORED,
+                fats REAL GENERATED ALWAYS AS ((recipe->>'fats')::real) STORED,
+                carbs REAL GENERATED ALWAYS AS ((recipe->>'carbs')::real) STORED,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        await connection.execute("""
+            CREATE INDEX IF NOT EXISTS daily_recipe_history_created_at_idx
+            ON daily_recipe_history (created_at DESC, id DESC)
+        """)
+        await _migrate_daily_recipe(connection)
+        # Время последнего запуска фоновых задач, чтобы перезапуск не сбивал расписание
         await connection.execute("""
-            CREATE TABLE IF NOT EXISTS daily_recipe (
+            CREATE TABLE IF NOT EXISTS scheduler_jobs (
+                job TEXT PRIMARY KEY,
+                last_run_at TIMESTAMPTZ,
+                last_success_at TIMESTAMPTZ,
+                last_error TEXT
+            )
+        """)
+        # Заранее сгенерированные рецепты на следующие дни; title_key — нормализованное
+        # название, уникальное, чтобы в очереди не было одинаковых блюд
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS daily_recipe_queue (
                 id SERIAL PRIMARY KEY,
                 recipe_text TEXT NOT NULL,
+                title_key TEXT NOT NULL UNIQUE,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
         logger.info("Checked/created all database tables")
 
-async def save_daily_recipe(pool, recipe_text):
-    async with pool.acquire() as connection:
-        await connection.execute("DELETE FROM daily_recipe")
+# Перенос рецепта из старой таблицы daily_recipe (одна строка, перезаписывалась
+# каждый день) в пустую историю. Старая таблица больше не пишется.
+async def _migrate_daily_recipe(connection):
+    exists = await connection.fetchval("SELECT to_regclass('daily_recipe') IS NOT NULL")
+    if not exists:
+        return
+    # Несколько процессов стартуют одновременно — переносит один
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", DAILY_RECIPE_LOCK_ID)
+        if await connection.fetchval("SELECT EXISTS (SELECT 1 FROM daily_recipe_history)"):
+            return
+        row = await connection.fetchrow(
+            "SELECT recipe_text, created_at FROM daily_recipe ORDER BY created_at DESC LIMIT 1"
+        )
+        recipe = parse_recipe(row["recipe_text"]) if row else None
+        if recipe is None:
+            return
+        # created_at в старой таблице — TIMESTAMP без пояса, время сервера БД
         await connection.execute(
-            "INSERT INTO daily_recipe (recipe_text) VALUES ($1)",
-            recipe_text
+            "INSERT INTO daily_recipe_history (recipe, created_at) VALUES ($1::jsonb, $2::timestamp)",
+            recipe.to_json(), row["created_at"]
         )
+    logger.info("Migrated daily recipe to daily_recipe_history")
+
+async def _append_daily_recipe(connection, recipe_text):
+    await connection.execute(
+        "INSERT INTO daily_recipe_history (recipe) VALUES ($1::jsonb)",
+        recipe_text
+    )
+
+async def save_daily_recipe(pool, recipe_text):
+    async with acquire(pool) as connection, stage("db_query"):
+        await _append_daily_recipe(connection, recipe_text)
+
+# Смена рецепта дня на первый из очереди одной транзакцией, без запроса к OpenAI.
+# None, если очередь пуста.
+async def pop_daily_recipe(pool):
+    async with acquire(pool) as connection, stage("db_query"):
+        async with connection.transaction():
+            recipe_text = await connection.fetchval("""
+                DELETE FROM daily_recipe_queue
+                WHERE id = (
+                    SELECT id FROM daily_recipe_queue ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING recipe_text
+            """)
+            if recipe_text is not None:
+                await _append_daily_recipe(connection, recipe_text)
+            return recipe_text
+
+# False, если такое блюдо в очереди уже есть
+async def enqueue_daily_recipe(pool, recipe_text, title_key):
+    async with acquire(pool) as connection, stage("db_query"):
+        inserted = await connection.fetchval("""
+            INSERT INTO daily_recipe_queue (recipe_text, title_key) VALUES ($1, $2)
+            ON CONFLICT (title_key) DO NOTHING
+            RETURNING id
+        """, recipe_text, title_key)
+        return inserted is not None
+
+async def get_queued_titles(pool):
+    async with acquire(pool) as connection, stage("db_query"):
+        rows = await connection.fetch("SELECT title_key FROM daily_recipe_queue ORDER BY id")
+        return [row["title_key"] for row in rows]
 
 async def get_latest_daily_recipe(pool):
-    async with pool.acquire() as connection:
+    async with acquire(pool) as connection, stage("db_query"):
         return await connection.fetchval(
-            "SELECT recipe_text FROM daily_recipe ORDER BY created_at DESC LIMIT 1"
-        )
\ No newline at end of file
+            "SELECT recipe FROM daily_recipe_history ORDER BY created_at DESC, id DESC LIMIT 1"
+        )
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Курсор страницы истории: "<микросекунды с 1970>_<id>" последней строки
+def history_cursor(row):
+    micros = (row["created_at"] - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{row['id']}"
+
+# Курсор или просто дата/время ISO 8601 ("2026-10-01") -> (created_at, id).
+# ValueError, если разобрать не удалось.
+def parse_history_cursor(value):
+    if "_" in value:
+        micros, row_id = value.split("_", 1)
+        return _EPOCH + timedelta(microseconds=int(micros)), int(row_id)
+    # "+" часового пояса в неэкранированном query превращается в пробел
+    moment = datetime.fromisoformat(value.replace(" ", "+"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment, 0
+
+# Самый новый рецепт дня вместе со временем его появления
+async def get_latest_daily_recipe_row(pool):
+    async with acquire(pool) as connection, stage("db_query"):
+        return await connection.fetchrow(
+            "SELECT recipe, created_at FROM daily_recipe_history ORDER BY created_at DESC, id DESC LIMIT 1"
+        )
+
+async def get_job_last_success(pool, job):
+    async with acquire(pool) as connection, stage("db_query"):
+        return await connection.fetchval("SELECT last_success_at FROM scheduler_jobs WHERE job = $1", job)
+
+async def record_job_run(pool, job, error=None):
+    async with acquire(pool) as connection, stage("db_query"):
+        await connection.execute("""
+            INSERT INTO scheduler_jobs (job, last_run_at, last_success_at, last_error)
+            VALUES ($1, now(), CASE WHEN $2::text IS NULL THEN now() END, $2::text)
+            ON CONFLICT (job) DO UPDATE SET
+                last_run_at = EXCLUDED.last_run_at,
+                last_success_at = COALESCE(EXCLUDED.last_success_at, scheduler_jobs.last_success_at),
+                last_error = EXCLUDED.last_error
+        """, job, error)
+
+async def ping(connection):
+    with stage("db_query"):
+        return await connection.fetchval("SELECT 1")
+
+# Страница истории от новых к старым: keyset по (created_at, id) и индексу,
+# без OFFSET. before — (created_at, id) последней строки предыдущей страницы.
+async def list_daily_recipes(pool, limit, before=None):
+    async with acquire(pool) as connection, stage("db_query"):
+        if before is None:
+            return await connection.fetch("""
+                SELECT id, recipe, created_at FROM daily_recipe_history
+                ORDER BY created_at DESC, id DESC
+                LIMIT $1
+            """, limit)
+        return await connection.fetch("""
+            SELECT id, recipe, created_at FROM daily_recipe_history
+            WHERE (created_at, id) < ($2::timestamptz, $3::bigint)
+            ORDER BY created_at DESC, id DESC
+            LIMIT $1
+        """, limit, *before)
+
+# Названия последних рецептов дня, чтобы не повторять их в очереди
+async def get_recent_titles(pool, limit):
+    async with acquire(pool) as connection, stage("db_query"):
+        rows = await connection.fetch(
+            "SELECT title FROM daily_recipe_history ORDER BY created_at DESC, id DESC LIMIT $1",
+            limit
+        )
+        return [row["title"] for row in rows if row["title"]]
+
+async def try_advisory_lock(connection, lock_id):
+    with stage("db_query"):
+        return await connection.fetchval("SELECT pg_try_advisory_lock($1)", lock_id)
+
+async def advisory_unlock(connection, lock_id):
+    with stage("db_query"):
+        return await connection.fetchval("SELECT pg_advisory_unlock($1)", lock_id)
\ No newline at end of file
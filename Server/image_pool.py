@@ -0,0 +1,176 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from config import logger, request_id_var, configure_worker_logging, SERVER_WORKERS, UPLOAD_MAX_SIZE
+from image_utils import prepare_image
+from upload_utils import check_upload_size
+
+class ImagePoolBusy(Exception):
+    # Очередь на сжатие заполнена — запрос нужно отклонить сразу
+    pass
+
+class _SharedBufferReader(io.RawIOBase):
+    # Файловый объект поверх memoryview разделяемой памяти: Pillow читает
+    # картинку прямо из неё, без копии в bytes
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        return self._pos
+
+    def readinto(self, buffer):
+        chunk = self._view[self._pos:self._pos + len(buffer)]
+        size = len(chunk)
+        buffer[:size] = chunk
+        chunk.release()
+        self._pos += size
+        return size
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+# Спул загрузки -> разделяемая память. Большой спул лежит на диске, поэтому
+# выполняется в потоке, а не в event loop
+def _copy_to_shared_memory(upload, shm):
+    offset = 0
+    for chunk in upload.iter_chunks():
+        shm.buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+
+# Выполняется в процессе-воркере; request_id — id запроса для строк лога
+def _prepare_from_shared_memory(name, size, request_id):
+    token = request_id_var.set(request_id)
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            reader = io.BufferedReader(_SharedBufferReader(shm.buf[:size]))
+            try:
+                return prepare_image(reader)
+            finally:
+                reader.close()
+        finally:
+            shm.close()
+    finally:
+        request_id_var.reset(token)
+
+class ImagePool:
+    # Отдельный пул процессов для сжатия фото: не делит GIL и дефолтный
+    # executor с event loop. Очередь ограничена max_pending — при переполнении
+    # сразу ImagePoolBusy, а не растущая задержка.
+
+    def __init__(self, workers=None, max_pending=None, timeout=None, max_size=UPLOAD_MAX_SIZE):
+        # По умолчанию ядра делятся поровну между воркерами сервера
+        self.workers = workers or max(1, (os.cpu_count() or 1) // SERVER_WORKERS)
+        self.max_pending = max_pending or self.workers * 4
+        self.timeout = timeout
+        self.max_size = max_size
+        self._executor = self._new_executor()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.restarts = 0
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=configure_worker_logging)
+
+    # Воркер умер (OOM на большом фото, падение кодека) — пул сломан целиком:
+    # заменяем его новым. Запросы, бывшие в старом пуле, получают BrokenProcessPool.
+    def _restart(self, executor):
+        if executor is not self._executor:
+            return  # уже пересоздан другим запросом
+        logger.error("Image process pool is broken, restarting it")
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+        self.restarts += 1
+
+    async def prepare(self, upload):
+        # upload — SpooledUpload; возвращает (сжатые bytes, перцептивный хэш)
+        check_upload_size(upload.size, self.max_size)
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise ImagePoolBusy()
+
+        self.pending += 1
+        shm = shared_memory.SharedMemory(create=True, size=max(upload.size, 1))
+        copy = asyncio.ensure_future(asyncio.to_thread(_copy_to_shared_memory, upload, shm))
+        try:
+            await asyncio.shield(copy)
+            executor = self._executor
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                executor, _prepare_from_shared_memory, shm.name, upload.size, request_id_var.get()
+            )
+        except asyncio.CancelledError:
+            # Поток ещё может писать в память — освобождаем её после него
+            copy.add_done_callback(lambda f: self._release(shm))
+            raise
+        except BrokenProcessPool:
+            self._release(shm)
+            self._restart(executor)
+            raise
+        except BaseException:
+            self._release(shm)
+            raise
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            # Клиент ушёл или время вышло, но воркер ещё читает память —
+            # освобождаем её после него
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                logger.error(f"Image compression took longer than {self.timeout}s")
+            future.add_done_callback(lambda f: self._release(shm))
+            raise
+        except BrokenProcessPool:
+            self._release(shm)
+            self._restart(executor)
+            raise
+        except BaseException:
+            self._release(shm)
+            raise
+        self._release(shm)
+        self.completed += 1
+        return result
+
+    def _release(self, shm):
+        self.pending -= 1
+        shm.close()
+        shm.unlink()
+
+    def shutdown(self):
+        logger.info("Shutting down image process pool")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "restarts": self.restarts,
+        }
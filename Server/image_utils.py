@@ -1,23 +1,74 @@
 import io
 from PIL import Image
-from config import logger
+from config import logger, IMAGE_MAX_SIDE, IMAGE_FAST_DECODE, IMAGE_JPEG_QUALITY
 
-def compress_image(file_data):  # Убрана async
+# Во сколько раз больше целевого размера оставляем картинку после draft/reduce,
+# чтобы финальный ресемплинг ещё давал хорошее качество
+REDUCING_GAP = 2
+
+# dHash: 64 бита — сравнение соседних пикселей в уменьшенном до 9x8 сером изображении
+def dhash_image(image, hash_size=8):
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+def compress_image(file_data, fast=IMAGE_FAST_DECODE):  # Убрана async
+    compressed_data, _ = prepare_image(file_data, fast=fast)
+    return compressed_data
+
+# Быстрое уменьшение: JPEG декодируется libjpeg сразу в 1/2, 1/4 или 1/8 масштаба
+# (draft), затем целочисленный reduce() до ~2x от цели и один дешёвый ресемплинг
+def _fast_thumbnail(image, max_side):
+    target = max_side * REDUCING_GAP
+    if image.format == "JPEG":
+        image.draft("RGB", (target, target))
+    factor = max(image.size) // target
+    if factor > 1:
+        # reduce() не умеет палитру (PNG, GIF) и 1-битные картинки
+        if image.mode == "1":
+            image = image.convert("L")
+        elif image.mode == "P":
+            image = image.convert("RGB")
+        image = image.reduce(factor)
+    image.thumbnail((max_side, max_side), Image.Resampling.BICUBIC, reducing_gap=None)
+    return image
+
+# Сжатие и перцептивный хэш по одной и той же миниатюре 512px
+def prepare_image(file_data, fast=IMAGE_FAST_DECODE):
     try:
         logger.info("Checking image size...")
-        image = Image.open(io.BytesIO(file_data))
+        # Принимаем как bytes, так и файловый объект (спул загрузки)
+        if isinstance(file_data, (bytes, bytearray, memoryview)):
+            file_data = io.BytesIO(file_data)
+        else:
+            file_data.seek(0)
+        image = Image.open(file_data)
         width, height = image.size
         logger.info(f"Original image size: {width}x{height} pixels")
         
-        image.thumbnail((512, 512), Image.Resampling.LANCZOS)
+        if fast:
+            image = _fast_thumbnail(image, IMAGE_MAX_SIDE)
+            quality = IMAGE_JPEG_QUALITY
+        else:
+            image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+            quality = 100
+        # PNG с прозрачностью и палитровые картинки JPEG не сохранит
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image_hash = dhash_image(image)
         compressed_width, compressed_height = image.size
         output = io.BytesIO()
-        image.save(output, format="JPEG", quality=100)
+        image.save(output, format="JPEG", quality=quality)
         compressed_data = output.getvalue()
         compressed_size_mb = len(compressed_data) / (1024 * 1024)
         logger.info(f"Compressed image size: {compressed_width}x{compressed_height} pixels, {compressed_size_mb:.2f} MB")
         
-        return compressed_data
+        return compressed_data, image_hash
     except Exception as e:
         logger.error(f"Error compressing image: {e}")
         raise
\ No newline at end of file
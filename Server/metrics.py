@@ -0,0 +1,216 @@
+import asyncio
+import bisect
+import contextvars
+import math
+import sys
+import time
+from tracing import span
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Метрики в формате Prometheus без внешних зависимостей.
+# Все observe()/inc() вызываются из потока event loop, поэтому обходимся
+# без блокировок: одно наблюдение — поиск корзины и два сложения.
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+# Маршрут, который сейчас обрабатывается; выставляет metrics_middleware
+current_handler = contextvars.ContextVar("metrics_handler", default="background")
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._upper = tuple(sorted(buckets))
+        # labels -> [счётчики по корзинам (+ одна для +Inf), сумма]
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self._upper) + 1), 0.0]
+        series[0][bisect.bisect_left(self._upper, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        bounds = self._upper + (math.inf,)
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield self.name + "_bucket", _format_labels(self.labelnames, labels, le), cumulative
+            yield self.name + "_sum", _format_labels(self.labelnames, labels), total
+            yield self.name + "_count", _format_labels(self.labelnames, labels), cumulative
+
+class CallbackMetric:
+    # Значения считываются в момент опроса: func() -> [(значения меток, число), ...]
+
+    def __init__(self, name, documentation, kind, labelnames, func):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._func = func
+
+    def samples(self):
+        for labels, value in self._func():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "recipe_stage_seconds",
+    "Duration of request processing stages",
+    ("handler", "stage")
+))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "recipe_http_request_seconds",
+    "HTTP request duration by route and status",
+    ("route", "status")
+))
+UPSTREAM_RESPONSES = REGISTRY.register(Counter(
+    "recipe_upstream_responses_total",
+    "OpenAI responses by endpoint and status code",
+    ("endpoint", "status")
+))
+UPSTREAM_RETRIES = REGISTRY.register(Counter(
+    "recipe_upstream_retries_total",
+    "Repeated OpenAI attempts by endpoint and reason",
+    ("endpoint", "reason")
+))
+UPSTREAM_HEDGES = REGISTRY.register(Counter(
+    "recipe_upstream_hedges_total",
+    "Hedged OpenAI attempts by endpoint and which attempt won",
+    ("endpoint", "winner")
+))
+
+EVENT_LOOP_LAG = REGISTRY.register(Histogram(
+    "recipe_event_loop_lag_seconds",
+    "How late the event loop wakes up a sleeping task",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+))
+
+# Задержка event loop: насколько позже срока просыпается sleep. Блокирующий
+# код в обработчиках виден здесь раньше, чем в задержке ответов.
+async def monitor_event_loop(interval=0.1):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+# Память процесса в байтах: текущий RSS (только Linux) и пиковый RSS
+def process_memory():
+    memory = {}
+    try:
+        with open("/proc/self/statm") as statm:
+            memory["rss_bytes"] = int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss в килобайтах, на macOS — в байтах
+        memory["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    return memory
+
+class _Stage:
+    # Этап = наблюдение в гистограмме + спан в трассе запроса
+    __slots__ = ("_name", "_span", "_started")
+
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._span = span(self._name)
+        self._span.__enter__()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self._started, current_handler.get(), self._name)
+        return self._span.__exit__(exc_type, exc, tb)
+
+# Замер этапа обработки текущего запроса:
+#   with stage("compress"):
+#       ...
+def stage(name):
+    return _Stage(name)
+
+def register_callback(name, documentation, kind, labelnames, func):
+    return REGISTRY.register(CallbackMetric(name, documentation, kind, labelnames, func))
+
+# Middleware: имя маршрута для замеров этапов и общее время запроса
+async def metrics_middleware(app, handler):
+    async def middleware_handler(request):
+        route = request.match_info.route.resource
+        route = route.canonical if route is not None else "unmatched"
+        token = current_handler.set(route)
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except Exception as e:
+            status = getattr(e, "status", 500)
+            raise
+        finally:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route, str(status))
+            current_handler.reset(token)
+    return middleware_handler
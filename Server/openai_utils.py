@@ -1,31 +1,371 @@
 import aiohttp
-import base64
-from config import logger, OPENAI_API_KEY
+import asyncio
+import hashlib
+import json
+import time
+from aiohttp import web
+from config import (
+    logger, truncate_payload, OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_TIMEOUT,
+    OPENAI_MAX_RETRIES, OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX, OPENAI_MAX_RETRY_WAIT,
+    OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN, OPENAI_HEDGE, OPENAI_HEDGE_QUANTILE,
+    OPENAI_HEDGE_MIN_DELAY, OPENAI_HEDGE_MIN_SAMPLES, OPENAI_RPM, OPENAI_TPM, WHISPER_RPM,
+    OPENAI_BACKGROUND_MAX_WAIT, OPENAI_BUDGET_MAX_WAIT
+)
+from budget import BACKGROUND, INTERACTIVE, UpstreamBudget, current_client
+from metrics import STAGE_SECONDS, UPSTREAM_RESPONSES, UPSTREAM_RETRIES, UPSTREAM_HEDGES, current_handler, stage
+from recipe import RESPONSE_FORMAT, parse_recipe
+from resilience import CircuitBreaker, LatencyWindow, backoff_delay, parse_retry_after
+from tracing import start_span
+from upstream_body import BASE64_MARKER, Base64JsonPayload, split_json_template
+
+# Коды, при которых запрос имеет смысл повторить
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Этап для метрик по адресу запроса к OpenAI
+def _upstream_stage(url):
+    return "whisper" if url.path.endswith("/audio/transcriptions") else "openai"
+
+async def _on_request_start(session, context, params):
+    context.started = time.perf_counter()
+    context.span = start_span(_upstream_stage(params.url), url=str(params.url))
+
+async def _on_request_end(session, context, params):
+    stage_name = _upstream_stage(params.url)
+    status = params.response.status
+    STAGE_SECONDS.observe(time.perf_counter() - context.started, current_handler.get(), stage_name)
+    UPSTREAM_RESPONSES.inc(stage_name, str(status))
+    if context.span is not None:
+        context.span.set("status", status)
+        context.span.finish(f"HTTP {status}" if status >= 400 else None)
+
+async def _on_request_exception(session, context, params):
+    stage_name = _upstream_stage(params.url)
+    STAGE_SECONDS.observe(time.perf_counter() - context.started, current_handler.get(), stage_name)
+    UPSTREAM_RESPONSES.inc(stage_name, "error")
+    if context.span is not None:
+        context.span.finish(params.exception)
+
+# Время до ответа и коды ответов OpenAI для всех запросов через общую сессию
+def openai_trace_config():
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
+    return trace_config
+
+# Выключатели, окна задержек и лимиты отдельно для Whisper и chat/completions
+# (у OpenAI лимиты считаются по каждой модели)
+_breakers = {}
+_latencies = {}
+_budgets = {
+    "openai": UpstreamBudget("openai", OPENAI_RPM, OPENAI_TPM, OPENAI_BACKGROUND_MAX_WAIT),
+    "whisper": UpstreamBudget("whisper", WHISPER_RPM, 0, OPENAI_BACKGROUND_MAX_WAIT),
+}
+
+def _breaker(endpoint):
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        breaker = _breakers[endpoint] = CircuitBreaker(endpoint, OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN)
+    return breaker
+
+def _latency_window(endpoint):
+    window = _latencies.get(endpoint)
+    if window is None:
+        window = _latencies[endpoint] = LatencyWindow()
+    return window
+
+def breaker_stats():
+    return {endpoint: breaker.stats() for endpoint, breaker in _breakers.items()}
+
+def budget_stats():
+    return {endpoint: budget.stats() for endpoint, budget in _budgets.items()}
+
+# Оценка токенов так же, как её делает лимитер OpenAI: символы / 4 плюс
+# max_tokens целиком; фото до 512px в режиме auto — 255 токенов
+IMAGE_TOKENS = 255
+
+def estimate_tokens(payload):
+    tokens = payload.get("max_tokens", 0)
+    for message in payload["messages"]:
+        for part in message["content"]:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4 + 1
+            elif part["type"] == "image_url":
+                tokens += IMAGE_TOKENS
+    return tokens
+
+# Ожидание своей очереди в пределах RPM/TPM. Приоритет по умолчанию —
+# интерактивный внутри запроса клиента и фоновый вне его (планировщик).
+async def _admit(budget, cost, priority):
+    client = current_client.get()
+    if priority is None:
+        priority = BACKGROUND if client is None else INTERACTIVE
+    with stage("upstream_queue"):
+        if priority == BACKGROUND:
+            await budget.acquire(cost, priority, client)
+        else:
+            await asyncio.wait_for(budget.acquire(cost, priority, client), OPENAI_BUDGET_MAX_WAIT)
+
+def _endpoint(path):
+    return "whisper" if path.endswith("audio/transcriptions") else "openai"
+
+# Пауза перед следующей попыткой или None, если пора сдаваться
+def _retry_delay(endpoint, attempt, reason, retry_after):
+    if attempt >= OPENAI_MAX_RETRIES:
+        return None
+    if retry_after is not None and retry_after > OPENAI_MAX_RETRY_WAIT:
+        logger.error(f"OpenAI {endpoint} asks to retry after {retry_after:.0f}s, giving up")
+        return None
+    UPSTREAM_RETRIES.inc(endpoint, reason)
+    return backoff_delay(attempt, OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX, retry_after)
+
+# Одна попытка: make_request() каждый раз собирает тело заново,
+# потому что FormData и генераторы тела нельзя отправить дважды
+async def _attempt(session, endpoint, url, make_request):
+    started = time.perf_counter()
+    timeout = aiohttp.ClientTimeout(total=OPENAI_TIMEOUT)
+    async with session.post(url, timeout=timeout, **make_request()) as response:
+        if response.status != 200:
+            return response.status, await response.text(), response.headers
+        result = await response.json()
+        _latency_window(endpoint).add(time.perf_counter() - started)
+        return response.status, result, response.headers
+
+# Hedged-запрос: если первая попытка дольше p95 недавних ответов, параллельно
+# запускаем вторую и берём первый успешный ответ, проигравшую отменяем.
+# Вторая попытка идёт без очереди бюджета: она нужна именно тогда, когда первая застряла.
+async def _hedged_attempt(session, endpoint, url, make_request):
+    window = _latency_window(endpoint)
+    if len(window) < OPENAI_HEDGE_MIN_SAMPLES:
+        return await _attempt(session, endpoint, url, make_request)
+    delay = max(OPENAI_HEDGE_MIN_DELAY, window.percentile(OPENAI_HEDGE_QUANTILE))
+
+    primary = asyncio.ensure_future(_attempt(session, endpoint, url, make_request))
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        hedged = not done
+        if hedged:
+            logger.info(f"OpenAI {endpoint} is slower than {delay:.1f}s, sending hedged request")
+            tasks.add(asyncio.ensure_future(_attempt(session, endpoint, url, make_request)))
+
+        result = error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                result = task.result()
+                if result[0] == 200:
+                    if hedged:
+                        UPSTREAM_HEDGES.inc(endpoint, "primary" if task is primary else "hedge")
+                    return result
+        if result is None:
+            raise error
+        return result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Общий вызов OpenAI: очередь в пределах лимитов аккаунта, повторы при 429/5xx
+# и сетевых ошибках с джиттером и учётом Retry-After, выключатель на адрес
+# и (опционально) hedged-запросы. cost — оценка токенов для лимита TPM.
+# Возвращает разобранный JSON ответа или None.
+async def openai_request(session, path, make_request, hedge=False, cost=0, priority=None):
+    endpoint = _endpoint(path)
+    url = f"{OPENAI_BASE_URL}/{path}"
+    breaker = _breaker(endpoint)
+    budget = _budgets[endpoint]
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            await _admit(budget, cost, priority)
+        except asyncio.TimeoutError:
+            logger.error(f"OpenAI {endpoint} rate limit budget not available in {OPENAI_BUDGET_MAX_WAIT:.0f}s")
+            return None
+        if not breaker.allow():
+            budget.refund(cost)
+            logger.error(f"OpenAI {endpoint} circuit is open, failing fast")
+            return None
+        retry_after = None
+        try:
+            if hedge and OPENAI_HEDGE:
+                status, body, headers = await _hedged_attempt(session, endpoint, url, make_request)
+            else:
+                status, body, headers = await _attempt(session, endpoint, url, make_request)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection"
+            logger.warning(f"OpenAI {endpoint} attempt {attempt + 1} failed: {e!r}")
+        except Exception:
+            # Например, битый JSON в ответе 200
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            if status == 200:
+                breaker.record_success()
+                budget.settle(headers, cost, (body.get("usage") or {}).get("total_tokens"))
+                return body
+            budget.settle(headers, cost)
+            logger.error(f"OpenAI API error: {status} - {truncate_payload(body)}")
+            # 4xx (кроме 429) — ошибка самого запроса, а не упавший upstream
+            if status < 500:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+            if status not in RETRY_STATUSES:
+                return None
+            reason = str(status)
+            retry_after = parse_retry_after(headers)
+
+        delay = _retry_delay(endpoint, attempt, reason, retry_after)
+        if delay is None:
+            return None
+        if reason == "429":
+            # Остальные запросы тоже подождут, а не получат тот же 429
+            budget.pause(delay)
+        logger.info(f"Retrying OpenAI {endpoint} in {delay:.2f}s ({reason})")
+        await asyncio.sleep(delay)
+    return None
+
+# Повторная отправка того же файла (ретраи клиента) не должна снова идти в Whisper
+# Одновременные ретраи склеиваются через flights (SingleFlight), если он передан
+async def transcribe_audio_cached(session, cache, audio_data, content_type="audio/m4a", filename="audio.m4a", flights=None):
+    # У SpooledUpload хэш уже посчитан при чтении запроса
+    key = getattr(audio_data, "sha256", None) or hashlib.sha256(audio_data).hexdigest()
+    transcription = cache.get(key)
+    if transcription is not None:
+        logger.info(f"Transcription cache hit for {key[:16]}")
+        return transcription
+
+    async def fetch():
+        transcription = await transcribe_audio(session, audio_data, content_type=content_type, filename=filename)
+        if transcription:
+            cache.set(key, transcription)
+        return transcription
+
+    if flights is None:
+        return await fetch()
+    return await flights.do(("audio", key), fetch)
+
+# Файл со спулом (SpooledUpload) отдаём в Whisper кусками, не собирая в bytes
+def _audio_body(audio_data):
+    if isinstance(audio_data, (bytes, bytearray, memoryview)):
+        return audio_data
+
+    async def chunks():
+        for chunk in audio_data.iter_chunks():
+            yield chunk
+    return chunks()
 
 async def transcribe_audio(session, audio_data, content_type="audio/m4a", filename="audio.m4a"):
     try:
         logger.info(f"Transcribing audio with OpenAI, content_type={content_type}, filename={filename}")
-        url = "https://api.openai.com/v1/audio/transcriptions"
         headers = {
             "Authorization": f"Bearer {OPENAI_API_KEY}"
         }
-        data = aiohttp.FormData()
-        data.add_field('file', audio_data, filename=filename, content_type=content_type)
-        data.add_field('model', 'whisper-1')
 
-        async with session.post(url, headers=headers, data=data) as response:
-            if response.status == 200:
-                result = await response.json()
-                logger.info("Audio transcribed successfully")
-                return result.get("text")
-            else:
-                error_text = await response.text()
-                logger.error(f"Transcription error: {response.status}, {error_text}")
-                return None
+        # Для каждой попытки новая форма и новый генератор, читающий файл с начала
+        def make_request():
+            data = aiohttp.FormData()
+            data.add_field('file', _audio_body(audio_data), filename=filename, content_type=content_type)
+            data.add_field('model', 'whisper-1')
+            return {"headers": headers, "data": data}
+
+        result = await openai_request(session, "audio/transcriptions", make_request)
+        if result is None:
+            return None
+        logger.info("Audio transcribed successfully")
+        return result.get("text")
+    except Exception as e:
+        logger.error(f"Error in audio transcription: {e}")
+        return None
+
+# Расшифровка StreamingUpload: первая попытка отправляет куски по мере загрузки
+# клиентом, повторные — из спула, дочитав загрузку до конца
+async def transcribe_audio_stream(session, upload, content_type="audio/m4a", filename="audio.m4a"):
+    try:
+        logger.info(f"Transcribing streamed audio with OpenAI, content_type={content_type}, filename={filename}")
+        headers = {
+            "Authorization": f"Bearer {OPENAI_API_KEY}"
+        }
+        attempts = 0
+
+        async def replay():
+            spooled = await upload.finish()
+            for chunk in spooled.iter_chunks():
+                yield chunk
+
+        def make_request():
+            nonlocal attempts
+            attempts += 1
+            body = upload.chunks() if attempts == 1 else replay()
+            data = aiohttp.FormData()
+            data.add_field('file', body, filename=filename, content_type=content_type)
+            data.add_field('model', 'whisper-1')
+            return {"headers": headers, "data": data}
+
+        # Клиент превысил лимит размера: запрос к Whisper отменяем сразу, а не
+        # повторяем (и не записываем выключателю как сбой OpenAI)
+        request = asyncio.ensure_future(openai_request(session, "audio/transcriptions", make_request))
+        upload.on_too_large = request.cancel
+        try:
+            result = await request
+        except asyncio.CancelledError:
+            if upload.error is None:
+                raise
+            raise upload.error
+        finally:
+            upload.on_too_large = None
+        if result is None:
+            return None
+        logger.info("Audio transcribed successfully")
+        return result.get("text")
+    except web.HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in audio transcription: {e}")
         return None
 
+def build_text_payload(transcription, stream=False):
+    prompt = (
+        " Ты — профессиональный кулинарный эксперт. Изучи Вопрос и верни ответ строго в формате JSON без обёртки ```json следующей структуры:\n\n"
+        "{\n"
+        '  "title": "Название блюда или ответа",\n'
+        '  "intro": "Ответ на вопрос. Если вопрос не связан с кулинарией то обыграй это с лёгким юмором но не отвечай",\n'
+        '  "ingredients": "Если ответ содержит рецепт приготовления блюда, то здесь ингредиенты в виде списка маркированного жирной точкой • , каждый с новой строки, для переноса строк используй \\n. Иначе none",\n'
+        '  "recipe": "Если ответ содержит рецепт приготовления блюда, то здесь подробный пошаговый рецепт приготовления с переносами строк через \\n. Иначе none ",\n'
+        '  "proteins": количество белков на 100 г блюда (в граммах, только число),\n'
+        '  "fats": количество жиров на 100 г блюда (в граммах, только число),\n'
+        '  "carbs": количество углеводов на 100 г блюда (в граммах, только число),\n'
+        '  "calories": калорийность 100 г блюда (в Ккал, только число)\n'
+        "}\n\n"
+        "ВАЖНО! ВЕСЬ ответ должен строго соответствовать указанной JSON-структуре, начинаться с символа { и быть корректным JSON-объектом! \n"
+        "Не используй знак решетки (#) для заголовков.\n\n"
+        f"Вопрос: {transcription}"
+    )
+
+    payload = {
+        "model": "gpt-4.1",
+        "messages": [
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": prompt}]
+            }
+        ],
+        "max_tokens": 4096,
+        "temperature": 0.7,
+        "response_format": RESPONSE_FORMAT
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+# Ответ модели ограничен схемой (response_format) и разбирается здесь же:
+# analyze_text/analyze_image/fetch_daily_recipe возвращают Recipe или None
 async def analyze_text_with_openai(session, transcription):
     try:
         logger.info("Sending text request to OpenAI...")
@@ -33,105 +373,180 @@ async def analyze_text_with_openai(session, transcription):
             "Authorization": f"Bearer {OPENAI_API_KEY}",
             "Content-Type": "application/json"
         }
-        prompt = (
-            " Ты — профессиональный кулинарный эксперт. Изучи Вопрос и верни ответ строго в формате JSON без обёртки ```json следующей структуры:\n\n"
-            "{\n"
-            '  "title": "Название блюда или ответа",\n'
-            '  "intro": "Ответ на вопрос. Если вопрос не связан с кулинарией то обыграй это с лёгким юмором но не отвечай",\n'
-            '  "ingredients": "Если ответ содержит рецепт приготовления блюда, то здесь ингредиенты в виде списка маркированного жирной точкой • , каждый с новой строки, для переноса строк используй \\n. Иначе none",\n'
-            '  "recipe": "Если ответ содержит рецепт приготовления блюда, то здесь подробный пошаговый рецепт приготовления с переносами строк через \\n. Иначе none ",\n'
-            '  "proteins": количество белков на 100 г блюда (в граммах, только число),\n'
-            '  "fats": количество жиров на 100 г блюда (в граммах, только число),\n'
-            '  "carbs": количество углеводов на 100 г блюда (в граммах, только число),\n'
-            '  "calories": калорийность 100 г блюда (в Ккал, только число)\n'
-            "}\n\n"
-            "ВАЖНО! ВЕСЬ ответ должен строго соответствовать указанной JSON-структуре, начинаться с символа { и быть корректным JSON-объектом! \n"
-            "Не используй знак решетки (#) для заголовков.\n\n"
-            f"Вопрос: {transcription}"
-        )
+        payload = build_text_payload(transcription)
 
-        payload = {
-            "model": "gpt-4.1",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": prompt}]
-                }
-            ],
-            "max_tokens": 4096,
-            "temperature": 0.7
-        }
-        
-        async with session.post(
-            "https://api.openai.com/v1/chat/completions", 
-            headers=headers, 
-            json=payload
-        ) as response:
-            if response.status != 200:
-                logger.error(f"OpenAI API error: {response.status} - {await response.text()}")
-                return None
-            result = await response.json()
-            return result["choices"][0]["message"]["content"]
+        result = await openai_request(
+            session, "chat/completions", lambda: {"headers": headers, "json": payload},
+            hedge=True, cost=estimate_tokens(payload)
+        )
+        if result is None:
+            return None
+        return parse_recipe(result["choices"][0]["message"]["content"])
     except Exception as e:
         logger.error(f"Error in OpenAI request: {e}")
         return None
 
+# Потоковый вариант: отдаёт куски ответа по мере генерации (stream: true).
+# Ошибки не глотаются — вызывающий сам решает, что отправить клиенту.
+async def stream_text_with_openai(session, transcription):
+    logger.info("Sending streaming text request to OpenAI...")
+    headers = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    payload = build_text_payload(transcription, stream=True)
+    cost = estimate_tokens(payload)
+    breaker = _breaker("openai")
+    budget = _budgets["openai"]
+    # Повторять можно только до первого байта ответа; таймаут — на паузу между кусками
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=OPENAI_TIMEOUT)
+
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            await _admit(budget, cost, None)
+        except asyncio.TimeoutError:
+            raise RuntimeError("OpenAI rate limit budget not available") from None
+        if not breaker.allow():
+            budget.refund(cost)
+            raise RuntimeError("OpenAI circuit is open")
+        retry_after = None
+        try:
+            response = await session.post(
+                f"{OPENAI_BASE_URL}/chat/completions",
+                headers=headers,
+                json=payload,
+                timeout=timeout
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection"
+            logger.warning(f"OpenAI stream attempt {attempt + 1} failed: {e!r}")
+        except Exception:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            budget.settle(response.headers, cost)
+            if response.status == 200:
+                breaker.record_success()
+                break
+            # Исход для выключателя — до чтения тела, которое тоже может упасть
+            if response.status < 500:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+            async with response:
+                error_text = await response.text()
+            logger.error(f"OpenAI API error: {response.status} - {truncate_payload(error_text)}")
+            if response.status not in RETRY_STATUSES:
+                raise RuntimeError(f"OpenAI API error: {response.status}")
+            reason = str(response.status)
+            retry_after = parse_retry_after(response.headers)
+
+        delay = _retry_delay("openai", attempt, reason, retry_after)
+        if delay is None:
+            raise RuntimeError(f"OpenAI API error: {reason}")
+        if reason == "429":
+            budget.pause(delay)
+        logger.info(f"Retrying OpenAI stream in {delay:.2f}s ({reason})")
+        await asyncio.sleep(delay)
+
+    async with response:
+        async for line in response.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+# Шаблон тела запроса анализа фото: вместо картинки в data URL — BASE64_MARKER,
+# сама картинка кодируется при отправке (Base64JsonPayload)
+def build_image_payload(caption=None):
+    prompt = (
+        " Ты — профессиональный кулинарный эксперт. Верни ответ строго в формате JSON следующей структуры:\n\n"
+        "{\n"
+        '  "title": "Название блюда",\n'
+        '  "intro": "Если на фото неприемлемый контент, то ОБЯЗАТЕЛЬНО тактично уйди от ответа здесь. Если на фото готовое блюдо: дай его краткое интересное описание. Если продукты — перечисли их, предложи возможное блюдо и дай его описание. Если один или несколько объектов на фото несъедобны - обыграй это с лёгким юмором. Если изображение на фото не связано с кулинарией, то не пиши рецепт и ингредиенты.", \n'
+        '  "ingredients": "Если ответ содержит рецепт приготовления блюда, то здесь ингредиенты в виде списка маркированного жирной точкой • , каждый с новой строки, для переноса строк используй \\n. Иначе none",\n'
+        '  "recipe": "Если ответ содержит рецепт приготовления блюда, то здесь подробный пошаговый рецепт приготовления с переносами строк через \\n. Иначе none ",\n'
+        '  "proteins": количество белков на 100 г блюда (в граммах, только число),\n'
+        '  "fats": количество жиров на 100 г блюда (в граммах, только число),\n'
+        '  "carbs": количество углеводов на 100 г блюда (в граммах, только число),\n'
+        '  "calories": калорийность 100 г блюда (в Ккал, только число)\n'
+        "}\n\n"
+        "ВАЖНО! ВЕСЬ ответ должен строго соответствовать указанной JSON-структуре, начинаться с символа { и быть корректным JSON-объектом! ДАЖЕ ЕСЛИ НА ФОТО НЕПРИЕМЛЕМЫЙ КОНТЕНТ!!!\n"
+        "Не используй знак решетки (#) для заголовков.\n\n"
+        "Если есть подпись, учти её для более точного ответа.\n\n"
+        f"Подпись: {caption if caption else 'Нет подписи'}"
+    )
+
+    payload = {
+        "model": "gpt-4.1",
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{BASE64_MARKER}"}}
+                ]
+            }
+        ],
+        "max_tokens": 4096,
+        "temperature": 0.7,
+        "response_format": RESPONSE_FORMAT
+    }
+    return payload
+
 async def analyze_image_with_openai(session, image_data, caption=None):
     try:
         logger.info("Sending image to OpenAI...")
-        base64_image = base64.b64encode(image_data).decode("utf-8")
         headers = {
             "Authorization": f"Bearer {OPENAI_API_KEY}",
             "Content-Type": "application/json"
         }
-        prompt = (
-            " Ты — профессиональный кулинарный эксперт. Верни ответ строго в формате JSON следующей структуры:\n\n"
-            "{\n"
-            '  "title": "Название блюда",\n'
-            '  "intro": "Если на фото неприемлемый контент, то ОБЯЗАТЕЛЬНО тактично уйди от ответа здесь. Если на фото готовое блюдо: дай его краткое интересное описание. Если продукты — перечисли их, предложи возможное блюдо и дай его описание. Если один или несколько объектов на фото несъедобны - обыграй это с лёгким юмором. Если изображение на фото не связано с кулинарией, то не пиши рецепт и ингредиенты.", \n'
-            '  "ingredients": "Если ответ содержит рецепт приготовления блюда, то здесь ингредиенты в виде списка маркированного жирной точкой • , каждый с новой строки, для переноса строк используй \\n. Иначе none",\n'
-            '  "recipe": "Если ответ содержит рецепт приготовления блюда, то здесь подробный пошаговый рецепт приготовления с переносами строк через \\n. Иначе none ",\n'
-            '  "proteins": количество белков на 100 г блюда (в граммах, только число),\n'
-            '  "fats": количество жиров на 100 г блюда (в граммах, только число),\n'
-            '  "carbs": количество углеводов на 100 г блюда (в граммах, только число),\n'
-            '  "calories": калорийность 100 г блюда (в Ккал, только число)\n'
-            "}\n\n"
-            "ВАЖНО! ВЕСЬ ответ должен строго соответствовать указанной JSON-структуре, начинаться с символа { и быть корректным JSON-объектом! ДАЖЕ ЕСЛИ НА ФОТО НЕПРИЕМЛЕМЫЙ КОНТЕНТ!!!\n"
-            "Не используй знак решетки (#) для заголовков.\n\n"
-            "Если есть подпись, учти её для более точного ответа.\n\n"
-            f"Подпись: {caption if caption else 'Нет подписи'}"
-        )
+        # image_data — уже сжатый JPEG
+        payload = build_image_payload(caption)
+        started = time.perf_counter()
+        prefix, suffix = split_json_template(payload)
+        template_seconds = time.perf_counter() - started
+        bodies = []
 
-        payload = {
-            "model": "gpt-4.1",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                    ]
-                }
-            ],
-            "max_tokens": 4096,
-            "temperature": 0.7
-        }
-        
-        async with session.post(
-            "https://api.openai.com/v1/chat/completions", 
-            headers=headers, 
-            json=payload
-        ) as response:
-            if response.status != 200:
-                logger.error(f"OpenAI API error: {response.status} - {await response.text()}")
-                return None
-            result = await response.json()
-            return result["choices"][0]["message"]["content"]
+        def make_request():
+            body = Base64JsonPayload(prefix, image_data, suffix)
+            bodies.append(body)
+            return {"headers": headers, "data": body}
+
+        try:
+            result = await openai_request(
+                session, "chat/completions", make_request,
+                hedge=True, cost=estimate_tokens(payload)
+            )
+        finally:
+            # base64 считается уже при отправке, внутри aiohttp: этап request_body —
+            # шаблон плюс кодирование во всех отправленных попытках
+            STAGE_SECONDS.observe(
+                template_seconds + sum(body.encode_seconds for body in bodies),
+                current_handler.get(), "request_body"
+            )
+        if result is None:
+            return None
+        return parse_recipe(result["choices"][0]["message"]["content"])
     except Exception as e:
         logger.error(f"Error in OpenAI image request: {e}")
         return None
 
-async def fetch_daily_recipe(session):
+# exclude — названия блюд, которые уже есть в очереди рецептов дня
+async def fetch_daily_recipe(session, exclude=()):
     try:
         logger.info("Fetching daily recipe from OpenAI...")
         headers = {
@@ -153,6 +568,8 @@ async def fetch_daily_recipe(session):
             "ВАЖНО! ВЕСЬ ответ должен строго соответствовать указанной JSON-структуре, начинаться с символа { и быть корректным JSON-объектом! \n"
             "Не используй знак решетки (#) для заголовков.\n\n"
         )
+        if exclude:
+            prompt += f"Не предлагай эти блюда: {', '.join(exclude)}.\n\n"
 
         payload = {
             "model": "gpt-4.1",
@@ -163,26 +580,18 @@ async def fetch_daily_recipe(session):
                 }
             ],
             "max_tokens": 4096,
-            "temperature": 0.7
+            "temperature": 0.7,
+            "response_format": RESPONSE_FORMAT
         }
-        
-        async with session.post(
-            "https://api.openai.com/v1/chat/completions", 
-            headers=headers, 
-            json=payload
-        ) as response:
-            if response.status != 200:
-                logger.error(f"OpenAI API error: {response.status} - {await response.text()}")
-                return None
-            result = await response.json()
-            response_text = result["choices"][0]["message"]["content"]
-            
-            # Очистка ответа от обёртки
-            if response_text.startswith("```json\n"):
-                response_text = response_text[8:]
-            if response_text.endswith("\n```"):
-                response_text = response_text[:-4]
-            return response_text.strip()
+
+        # Фоновая задача: пропускает вперёд запросы пользователей, hedged-запросы не нужны
+        result = await openai_request(
+            session, "chat/completions", lambda: {"headers": headers, "json": payload},
+            cost=estimate_tokens(payload), priority=BACKGROUND
+        )
+        if result is None:
+            return None
+        return parse_recipe(result["choices"][0]["message"]["content"])
     except Exception as e:
         logger.error(f"Error fetching daily recipe: {e}")
         return None
\ No newline at end of file
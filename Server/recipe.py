@@ -0,0 +1,135 @@
+import json
+import re
+from config import logger, truncate_payload
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него — стандартный json
+    orjson = None
+
+# Сериализация ответов в UTF-8 bytes: orjson, если установлен
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class RecipeError(ValueError):
+    pass
+
+# Поля рецепта -> тип; порядок совпадает с RecipeData в Android-приложении
+TEXT_FIELDS = ("title", "intro", "ingredients", "recipe")
+NUMBER_FIELDS = ("proteins", "fats", "carbs")
+INTEGER_FIELDS = ("calories",)
+
+# JSON Schema для structured outputs (response_format) OpenAI
+RECIPE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **{name: {"type": "string"} for name in TEXT_FIELDS},
+        **{name: {"type": "number"} for name in NUMBER_FIELDS},
+        **{name: {"type": "integer"} for name in INTEGER_FIELDS},
+    },
+    "required": list(TEXT_FIELDS + NUMBER_FIELDS + INTEGER_FIELDS),
+    "additionalProperties": False,
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "recipe", "strict": True, "schema": RECIPE_SCHEMA},
+}
+
+_NUMBER = re.compile(r"-?\d+(?:[.,]\d+)?")
+
+# Модель иногда всё равно оборачивает JSON в ```json ... ```
+def strip_json_fence(text):
+    text = text.strip()
+    if text.startswith("```json"):
+        text = text[7:]
+    elif text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+def _number(name, value):
+    if isinstance(value, bool):
+        raise RecipeError(f"Field '{name}' must be a number")
+    if isinstance(value, (int, float)):
+        return float(value)
+    # Старые ответы без схемы: "12 г", "12,5"
+    if isinstance(value, str):
+        match = _NUMBER.search(value)
+        if match:
+            return float(match.group().replace(",", "."))
+    raise RecipeError(f"Field '{name}' must be a number")
+
+class Recipe:
+    # Рецепт, проверенный один раз при получении от OpenAI.
+    # В кэшах хранится сам объект, JSON-строка считается один раз и запоминается.
+    __slots__ = TEXT_FIELDS + NUMBER_FIELDS + INTEGER_FIELDS + ("_json",)
+
+    def __init__(self, title, intro, ingredients, recipe, proteins, fats, carbs, calories):
+        self.title = title
+        self.intro = intro
+        self.ingredients = ingredients
+        self.recipe = recipe
+        self.proteins = proteins
+        self.fats = fats
+        self.carbs = carbs
+        self.calories = calories
+        self._json = None
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise RecipeError("Recipe must be a JSON object")
+        values = {}
+        for name in TEXT_FIELDS:
+            value = data.get(name)
+            if not isinstance(value, str):
+                raise RecipeError(f"Field '{name}' must be a string")
+            values[name] = value
+        for name in NUMBER_FIELDS:
+            values[name] = _number(name, data.get(name))
+        for name in INTEGER_FIELDS:
+            values[name] = int(round(_number(name, data.get(name))))
+        return cls(**values)
+
+    @classmethod
+    def from_json(cls, text):
+        try:
+            data = loads(strip_json_fence(text))
+        except ValueError as e:
+            raise RecipeError(f"Invalid JSON: {e}") from None
+        return cls.from_dict(data)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__[:-1]}
+
+    # Каноничная JSON-строка: её хранит БД и её же получают старые клиенты
+    def to_json(self):
+        if self._json is None:
+            self._json = dumps(self.to_dict()).decode("utf-8")
+        return self._json
+
+    def __repr__(self):
+        return f"Recipe(title={self.title!r})"
+
+# Разбор ответа модели или строки из БД; None, если он не соответствует схеме
+def parse_recipe(text):
+    try:
+        return Recipe.from_json(text)
+    except RecipeError as e:
+        logger.error(f"Invalid recipe: {e}: {truncate_payload(text)}")
+        return None
+
+# Тело ответа с рецептом. Старый формат (по умолчанию) — рецепт строкой внутри
+# JSON, как его разбирает Android-приложение; typed (?v=2) — один JSON-документ.
+def recipe_payload(recipe, typed, **extra):
+    extra["recipe"] = recipe.to_dict() if typed else recipe.to_json()
+    return extra
@@ -0,0 +1,106 @@
+import collections
+import email.utils
+import random
+import time
+
+class CircuitBreaker:
+    # closed -> (threshold подряд ошибок) -> open -> (cooldown) -> half_open
+    # В half_open пропускается один пробный запрос: успех закрывает цепь,
+    # ошибка снова открывает её на cooldown.
+
+    def __init__(self, name, threshold=5, cooldown=30.0, clock=time.monotonic):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.opened_total = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if self._clock() - self.opened_at < self.cooldown:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+        # half_open: только один пробный запрос одновременно
+        if self._probe_in_flight:
+            self.rejected += 1
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        self.state = "closed"
+
+    # Попытка прервана (отмена запроса), исход неизвестен: снимаем только флаг
+    # пробного запроса, чтобы следующий вызов мог стать пробным
+    def release(self):
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.opened_total += 1
+            self.state = "open"
+            self.opened_at = self._clock()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened_total": self.opened_total,
+            "rejected": self.rejected,
+        }
+
+class LatencyWindow:
+    # Задержки последних успешных запросов для порога hedged-запросов
+    def __init__(self, size=200):
+        self._samples = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, q):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# Экспоненциальная задержка с полным джиттером; Retry-After от сервера важнее
+def backoff_delay(attempt, base, cap, retry_after=None):
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def parse_retry_after(headers):
+    # OpenAI присылает retry-after-ms, стандартный Retry-After — в секундах или HTTP-дата
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import logging
+import os
+import select
+import signal
+import sys
+import time
+from dotenv import load_dotenv
+
+# Pre-fork запуск: мастер-процесс запускает SERVER_WORKERS воркеров, каждый слушает
+# тот же порт через SO_REUSEPORT (соединения между ними распределяет ядро).
+# SIGHUP — поочерёдный перезапуск без простоя (новый воркер поднимается до остановки
+# старого, новый код подхватывается), SIGTERM/SIGINT — плавная остановка всех.
+#
+# Мастер не импортирует config и server: config запускает поток записи логов,
+# а потоки не переживают fork. Воркер импортирует их сам, уже после fork.
+
+load_dotenv()
+
+logger = logging.getLogger("runner")
+logger.propagate = False
+_handler = logging.StreamHandler()
+_handler.setFormatter(logging.Formatter("%(asctime)s - runner - %(levelname)s - %(message)s"))
+logger.addHandler(_handler)
+logger.setLevel(logging.INFO)
+
+# Воркер, упавший быстрее этого, считается упавшим при старте: перезапуск с задержкой
+CRASH_WINDOW = 5
+CRASH_BACKOFF_MAX = 30
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the recipe server as several pre-forked workers")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVER_WORKERS", "0")),
+                        help="number of worker processes (0 — one per CPU core)")
+    parser.add_argument("--no-uvloop", dest="uvloop", action="store_false",
+                        default=os.getenv("SERVER_UVLOOP", "1") == "1")
+    parser.add_argument("--shutdown-timeout", type=float,
+                        default=float(os.getenv("SERVER_SHUTDOWN_TIMEOUT", "30")))
+    parser.add_argument("--ready-timeout", type=float,
+                        default=float(os.getenv("SERVER_READY_TIMEOUT", "60")))
+    args = parser.parse_args()
+    args.workers = args.workers or os.cpu_count() or 1
+    return args
+
+# Воркер
+
+async def serve(args, ready_fd):
+    from aiohttp import web
+    from config import logger as server_logger
+    from server import init_app
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    app = await init_app()
+    runner = web.AppRunner(app, handle_signals=False, shutdown_timeout=args.shutdown_timeout)
+    await runner.setup()
+    site = web.TCPSite(runner, args.host, args.port, reuse_port=True)
+    await site.start()
+    server_logger.info(f"Worker {os.getpid()} listening on {args.host}:{args.port}")
+    # Сообщаем мастеру, что порт слушается и приложение готово
+    os.write(ready_fd, b"1")
+    os.close(ready_fd)
+
+    await stop.wait()
+    server_logger.info(f"Worker {os.getpid()} shutting down")
+    await runner.cleanup()
+
+def run_worker(args, ready_fd):
+    # Обработчики сигналов мастера унаследованы через fork — возвращаем свои.
+    # Ctrl+C приходит всей группе процессов; воркеры останавливает мастер.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    # Уже разрешённое число воркеров — для размера пулов БД и сжатия фото
+    os.environ["SERVER_WORKERS"] = str(args.workers)
+    if args.uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+    asyncio.run(serve(args, ready_fd))
+
+# Мастер
+
+class Master:
+    def __init__(self, args):
+        self.args = args
+        self.workers = {}  # pid -> (номер слота, время запуска)
+        self.retiring = set()  # pid, которые остановлены намеренно и не перезапускаются
+        self.crashes = {}  # слот -> число падений подряд при старте
+        self.dead = []  # слоты упавших воркеров, ждущие перезапуска
+        self.stopping = False
+        self.reload = False
+
+    def spawn(self, slot):
+        ready_r, ready_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            code = 0
+            try:
+                run_worker(self.args, ready_w)
+            except BaseException:
+                logging.getLogger("runner").exception("Worker failed")
+                code = 1
+            finally:
+                # os._exit не вызывает atexit: последние записи из очереди логов
+                # дописываем сами, иначе они теряются вместе с потоком записи
+                config = sys.modules.get("config")
+                if config is not None:
+                    config.log_listener.stop()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(ready_w)
+        self.workers[pid] = (slot, time.monotonic())
+        logger.info(f"Started worker {pid} (slot {slot})")
+        return pid, ready_r
+
+    def wait_ready(self, pid, ready_fd):
+        # Ждём байт готовности; EOF значит, что воркер умер при старте
+        try:
+            deadline = time.monotonic() + self.args.ready_timeout
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    logger.error(f"Worker {pid} not ready after {self.args.ready_timeout}s")
+                    return False
+                readable, _, _ = select.select([ready_fd], [], [], timeout)
+                if readable:
+                    if os.read(ready_fd, 1):
+                        return True
+                    logger.error(f"Worker {pid} exited during startup")
+                    return False
+        finally:
+            os.close(ready_fd)
+
+    def start(self):
+        # Первый воркер создаёт таблицы и мигрирует данные; остальные стартуют,
+        # когда схема уже готова, чтобы не гонять DDL параллельно
+        pid, ready_fd = self.spawn(0)
+        if not self.wait_ready(pid, ready_fd):
+            self.terminate([pid])
+            return False
+        pending = [self.spawn(slot) for slot in range(1, self.args.workers)]
+        for pid, ready_fd in pending:
+            self.wait_ready(pid, ready_fd)
+        logger.info(f"Running {self.args.workers} workers on {self.args.host}:{self.args.port}")
+        return True
+
+    def rolling_restart(self):
+        # По одному: новый воркер слушает порт вместе со старым, затем старый
+        # дорабатывает начатые запросы и выходит
+        logger.info("Rolling restart")
+        for old_pid, (slot, _) in list(self.workers.items()):
+            if self.stopping:
+                return
+            if old_pid not in self.workers:
+                continue
+            pid, ready_fd = self.spawn(slot)
+            if not self.wait_ready(pid, ready_fd):
+                logger.error("Rolling restart aborted, keeping old workers")
+                self.terminate([pid])
+                return
+            self.terminate([old_pid])
+        logger.info("Rolling restart finished")
+
+    def terminate(self, pids):
+        # SIGTERM и ожидание; не успевшие за shutdown_timeout получают SIGKILL
+        pids = [pid for pid in pids if pid in self.workers]
+        for pid in pids:
+            self.retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.args.shutdown_timeout + 5
+        while pids and time.monotonic() < deadline:
+            self.reap()
+            pids = [pid for pid in pids if pid in self.workers]
+            if pids:
+                time.sleep(0.1)
+        for pid in pids:
+            logger.warning(f"Worker {pid} did not stop in time, killing")
+            self._kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.workers.pop(pid, None)
+            self.retiring.discard(pid)
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        # Собираем завершившиеся воркеры; слоты неожиданно упавших — в очередь
+        # на перезапуск
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid not in self.workers:
+                continue
+            slot, started_at = self.workers.pop(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            logger.error(f"Worker {pid} (slot {slot}) exited with status {os.waitstatus_to_exitcode(status)}")
+            if time.monotonic() - started_at < CRASH_WINDOW:
+                self.crashes[slot] = self.crashes.get(slot, 0) + 1
+            else:
+                self.crashes[slot] = 0
+            self.dead.append(slot)
+
+    def respawn(self, slot):
+        crashes = self.crashes.get(slot, 0)
+        if crashes:
+            delay = min(CRASH_BACKOFF_MAX, 2 ** (crashes - 1))
+            logger.info(f"Restarting slot {slot} in {delay}s")
+            deadline = time.monotonic() + delay
+            while time.monotonic() < deadline and not self.stopping:
+                time.sleep(0.1)
+            if self.stopping:
+                return
+        pid, ready_fd = self.spawn(slot)
+        self.wait_ready(pid, ready_fd)
+
+    def on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload = True
+        else:
+            self.stopping = True
+
+    def run(self):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.on_signal)
+        if not self.start():
+            return 1
+        while not self.stopping:
+            if self.reload:
+                self.reload = False
+                self.rolling_restart()
+            self.reap()
+            while self.dead and not self.stopping:
+                self.respawn(self.dead.pop(0))
+            time.sleep(0.2)
+        logger.info("Stopping workers")
+        self.terminate(list(self.workers))
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(Master(parse_args()).run())
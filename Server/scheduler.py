@@ -1,23 +1,259 @@
 import asyncio
-from config import logger
-from db import save_daily_recipe
+import random
+import time
+from datetime import datetime, timedelta
+from cache import normalize_text
+from config import (
+    logger, DAILY_RECIPE_LOCK_TIMEOUT, DAILY_RECIPE_BUFFER_SIZE, DAILY_RECIPE_PREGEN_CONCURRENCY,
+    DAILY_RECIPE_OFFPEAK_HOURS, DAILY_RECIPE_PREGEN_INTERVAL, DAILY_RECIPE_RECENT_TITLES,
+    DAILY_RECIPE_ROTATE_AT, DAILY_RECIPE_RETRY_INTERVAL, DAILY_RECIPE_RETRY_MAX,
+    DAILY_RECIPE_REFRESH_INTERVAL, SCHEDULER_HEARTBEAT, SCHEDULER_LEADER_RETRY
+)
+from db import (
+    acquire, save_daily_recipe, get_latest_daily_recipe_row, pop_daily_recipe,
+    enqueue_daily_recipe, get_queued_titles, get_recent_titles, try_advisory_lock, advisory_unlock,
+    get_job_last_success, record_job_run, ping,
+    DAILY_RECIPE_LOCK_ID, DAILY_RECIPE_PREGEN_LOCK_ID, SCHEDULER_LOCK_ID
+)
 from openai_utils import fetch_daily_recipe  # Добавлен импорт
+from recipe import parse_recipe
 
-async def schedule_daily_recipe_update(app):
+# Имя задачи смены рецепта дня в scheduler_jobs
+DAILY_RECIPE_JOB = "daily_recipe"
+
+# Перегенерация рецепта дня. Внутри процесса одновременные вызовы склеиваются
+# через app['inflight'], между процессами — через advisory-lock в Postgres:
+# рецепт у OpenAI запрашивает только один, остальные получают его из БД.
+# Каждая смена записывается в scheduler_jobs — и от лидера, и из запроса
+# (stale-while-revalidate), иначе лидер сменит рецепт второй раз за сутки.
+async def regenerate_daily_recipe(app):
+    return await app['inflight'].do(("daily_recipe",), _regenerate_daily_recipe, app)
+
+async def _regenerate_daily_recipe(app):
+    pool = app['db_pool']
+    daily = app['daily_recipe']
+    daily.last_attempt = time.time()
+
+    async with acquire(pool) as connection:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + DAILY_RECIPE_LOCK_TIMEOUT
+        while not await try_advisory_lock(connection, DAILY_RECIPE_LOCK_ID):
+            if loop.time() >= deadline:
+                logger.warning("Timed out waiting for daily recipe lock")
+                return None
+            await asyncio.sleep(0.5)
+
+        try:
+            # Проверяем только под блокировкой: пока ждали её (или ещё до вызова),
+            # рецепт на этот период мог сменить другой процесс
+            row = await get_latest_daily_recipe_row(pool)
+            if row and row["created_at"].timestamp() >= previous_run_time(time.time()):
+                recipe = parse_recipe(row["recipe"])
+                if recipe is not None:
+                    logger.info("Daily recipe is already fresh, not rotating")
+                    daily.update(recipe)
+                    return recipe
+
+            # Обычно следующий рецепт уже лежит в очереди: смена без запроса к OpenAI
+            recipe_text = await pop_daily_recipe(pool)
+            recipe = parse_recipe(recipe_text) if recipe_text else None
+            if recipe is not None:
+                daily.update(recipe)
+                if daily.buffered:
+                    daily.buffered -= 1
+                logger.info(f"Rotated daily recipe from pre-generated queue: {recipe.title}")
+                await record_job_run(pool, DAILY_RECIPE_JOB)
+                return recipe
+
+            logger.warning("Daily recipe queue is empty, fetching from OpenAI")
+            recipe = await fetch_daily_recipe(app['http_session'])
+            if recipe is None:
+                logger.warning("Failed to fetch daily recipe")
+                daily.stale = True
+                return None
+            await save_daily_recipe(pool, recipe.to_json())
+            daily.update(recipe)
+            logger.info("Daily recipe saved to database")
+            await record_job_run(pool, DAILY_RECIPE_JOB)
+            return recipe
+        finally:
+            await advisory_unlock(connection, DAILY_RECIPE_LOCK_ID)
+
+# Часы наименьшей нагрузки: окно "с-по" может переходить через полночь
+def in_offpeak(hour, window=DAILY_RECIPE_OFFPEAK_HOURS):
+    start, end = window
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+# Дополнение очереди до DAILY_RECIPE_BUFFER_SIZE рецептов параллельными запросами.
+# Одинаковые блюда отбрасываются (уникальный title_key), попыток не больше 2×недостачи.
+# Возвращает число добавленных рецептов или None, если очередь наполняет другой процесс.
+async def fill_daily_recipe_queue(app):
+    pool = app['db_pool']
+    async with acquire(pool) as connection:
+        if not await try_advisory_lock(connection, DAILY_RECIPE_PREGEN_LOCK_ID):
+            return None
+        try:
+            titles = await get_queued_titles(pool)
+            queued = len(titles)
+            app['daily_recipe'].buffered = queued
+            missing = DAILY_RECIPE_BUFFER_SIZE - queued
+            if missing <= 0:
+                return 0
+
+            # Не повторяем и недавние рецепты дня из истории
+            for title in await get_recent_titles(pool, DAILY_RECIPE_RECENT_TITLES):
+                key = normalize_text(title)
+                if key not in titles:
+                    titles.append(key)
+            claimed = 0
+            attempts = 0
+            added = 0
+
+            async def worker():
+                nonlocal claimed, attempts, added
+                while claimed < missing and attempts < missing * 2:
+                    claimed += 1
+                    attempts += 1
+                    recipe = await fetch_daily_recipe(app['http_session'], exclude=titles)
+                    key = normalize_text(recipe.title) if recipe is not None else None
+                    if key and key not in titles and await enqueue_daily_recipe(pool, recipe.to_json(), key):
+                        titles.append(key)
+                        added += 1
+                        continue
+                    if recipe is not None:
+                        logger.info(f"Rejected duplicate daily recipe: {recipe.title}")
+                    claimed -= 1
+
+            logger.info(f"Pre-generating {missing} daily recipes")
+            await asyncio.gather(*(worker() for _ in range(min(missing, DAILY_RECIPE_PREGEN_CONCURRENCY))))
+            app['daily_recipe'].buffered = queued + added
+            logger.info(f"Daily recipe queue: {added} added, {app['daily_recipe'].buffered} buffered")
+            return added
+        finally:
+            await advisory_unlock(connection, DAILY_RECIPE_PREGEN_LOCK_ID)
+
+# Фоновое наполнение очереди: в часы наименьшей нагрузки, а при пустой
+# очереди — сразу, чтобы смена рецепта не зависела от OpenAI
+async def pregenerate_daily_recipes(app):
+    while True:
+        try:
+            if in_offpeak(time.localtime().tm_hour) or not app['daily_recipe'].buffered:
+                await fill_daily_recipe_queue(app)
+        except Exception as e:
+            logger.error(f"Error pre-generating daily recipes: {e}")
+        await asyncio.sleep(DAILY_RECIPE_PREGEN_INTERVAL)
+
+# Ближайший после момента after (unix) запуск по расписанию "ЧЧ:ММ" в локальном
+# времени: переход на летнее время и сдвиги часов не копятся, как у sleep(24 ч)
+def next_run_time(after, at=DAILY_RECIPE_ROTATE_AT):
+    moment = datetime.fromtimestamp(after)
+    candidate = moment.replace(hour=at[0], minute=at[1], second=0, microsecond=0)
+    if candidate <= moment:
+        candidate += timedelta(days=1)
+    return candidate.timestamp()
+
+# Последний запуск по расписанию, который уже должен был состояться
+def previous_run_time(now, at=DAILY_RECIPE_ROTATE_AT):
+    moment = datetime.fromtimestamp(now)
+    candidate = moment.replace(hour=at[0], minute=at[1], second=0, microsecond=0)
+    if candidate > moment:
+        candidate -= timedelta(days=1)
+    return candidate.timestamp()
+
+# Ожидание до момента deadline (unix) с проверкой соединения, на котором держится
+# блокировка лидера: если оно оборвалось, лидерство потеряно — исключение
+async def _sleep_as_leader(connection, deadline):
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, SCHEDULER_HEARTBEAT))
+        await ping(connection)
+
+async def _last_rotation(pool):
+    last_success = await get_job_last_success(pool, DAILY_RECIPE_JOB)
+    if last_success is None:
+        # Первый запуск с этой таблицей: считаем по последнему рецепту в истории
+        row = await get_latest_daily_recipe_row(pool)
+        last_success = row["created_at"] if row else None
+    return last_success.timestamp() if last_success else None
+
+# Работа лидера: смена рецепта дня по расписанию (с догоняющим запуском, если
+# пропущена, пока лидера не было) и наполнение очереди рецептов
+async def _lead(app, connection):
+    pool = app['db_pool']
+    daily = app['daily_recipe']
+    pregenerate = asyncio.create_task(pregenerate_daily_recipes(app))
+    failures = 0
+    try:
+        while True:
+            last_run = await _last_rotation(pool)
+            if last_run is not None and last_run >= previous_run_time(time.time()):
+                failures = 0
+                await _sleep_as_leader(connection, next_run_time(time.time()))
+                continue
+
+            logger.info("Running scheduled daily recipe update...")
+            error = None
+            try:
+                if await regenerate_daily_recipe(app) is None:
+                    error = "Daily recipe was not updated"
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            await record_job_run(pool, DAILY_RECIPE_JOB, error)
+            if error is None:
+                logger.info("Scheduled daily recipe update completed")
+                continue
+
+            daily.stale = True
+            delay = min(DAILY_RECIPE_RETRY_MAX, DAILY_RECIPE_RETRY_INTERVAL * 2 ** failures) * random.uniform(0.5, 1)
+            failures += 1
+            logger.error(f"Scheduled daily recipe update failed ({error}), retrying in {delay:.0f}s")
+            await _sleep_as_leader(connection, time.time() + delay)
+    finally:
+        pregenerate.cancel()
+
+# Выборы лидера: фоновые задачи выполняет только процесс, получивший advisory-lock.
+# Блокировка живёт вместе с соединением, поэтому при падении лидера её
+# через SCHEDULER_LEADER_RETRY подхватывает другой процесс.
+async def run_scheduler(app):
     # Даем серверу время на запуск перед первым обновлением
     await asyncio.sleep(10)
-    
     while True:
         try:
-            logger.info("Running scheduled daily recipe update...")
-            recipe_text = await fetch_daily_recipe(app['http_session'])
-            if recipe_text:
-                await save_daily_recipe(app['db_pool'], recipe_text)
-                logger.info("Daily recipe saved to database")
+            async with acquire(app['db_pool']) as connection:
+                if await try_advisory_lock(connection, SCHEDULER_LOCK_ID):
+                    logger.info("This worker is the scheduler leader")
+                    try:
+                        await _lead(app, connection)
+                    finally:
+                        try:
+                            await advisory_unlock(connection, SCHEDULER_LOCK_ID)
+                        except Exception:
+                            pass
+        except Exception as e:
+            logger.error(f"Scheduler leader lost: {e}")
+        await asyncio.sleep(SCHEDULER_LEADER_RETRY)
+
+# Во всех процессах: новый рецепт дня из БД (его сменил лидер) и время
+# следующей смены для Cache-Control
+async def refresh_daily_recipe(app):
+    daily = app['daily_recipe']
+    while True:
+        try:
+            now = time.time()
+            row = await get_latest_daily_recipe_row(app['db_pool'])
+            recipe = parse_recipe(row["recipe"]) if row else None
+            if recipe is not None and (daily.recipe is None or recipe.to_json() != daily.recipe.to_json()):
+                logger.info(f"Loaded new daily recipe from database: {recipe.title}")
+                daily.update(recipe)
+            # Смена по расписанию задерживается — не обещаем клиентам кэш до завтра
+            if row is None or row["created_at"].timestamp() < previous_run_time(now):
+                daily.next_update = None
             else:
-                logger.warning("Failed to fetch daily recipe")
-                
-            logger.info("Scheduled daily recipe update completed, waiting 24 hours...")
+                daily.next_update = next_run_time(now)
         except Exception as e:
-            logger.error(f"Error in scheduled recipe update: {e}")
-        await asyncio.sleep(24 * 60 * 60)  # 24 часа
\ No newline at end of file
+            logger.error(f"Error refreshing daily recipe: {e}")
+        await asyncio.sleep(DAILY_RECIPE_REFRESH_INTERVAL)
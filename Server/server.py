@@ -1,19 +1,186 @@
 import aiohttp
 import asyncio
-import os
 from aiohttp import web
-from config import logger
-from db import init_db_pool, create_tables, get_latest_daily_recipe
-from image_utils import compress_image
-from openai_utils import transcribe_audio, analyze_text_with_openai, analyze_image_with_openai, fetch_daily_recipe
-from scheduler import schedule_daily_recipe_update
+from concurrent.futures.process import BrokenProcessPool
+from admission import admission_middleware, create_limiters
+from cache import TTLCache, PerceptualHashIndex, normalize_text
+from config import (
+    logger, request_id_var, truncate_payload, queue_handler, rate_limit_filter, TEXT_CACHE_MAX_SIZE, TEXT_CACHE_TTL,
+    IMAGE_CACHE_MAX_SIZE, IMAGE_CACHE_TTL, IMAGE_HASH_MAX_DISTANCE,
+    AUDIO_CACHE_MAX_SIZE, AUDIO_CACHE_TTL,
+    DAILY_RECIPE_WAIT_TIMEOUT, DAILY_RECIPE_RETRY_INTERVAL, DAILY_RECIPES_PAGE_SIZE, DAILY_RECIPES_MAX_PAGE_SIZE,
+    IMAGE_POOL_WORKERS, IMAGE_POOL_MAX_PENDING, IMAGE_POOL_RETRY_AFTER, IMAGE_POOL_TIMEOUT,
+    SERVER_HOST, SERVER_PORT, SERVER_SHUTDOWN_TIMEOUT, AUDIO_PASSTHROUGH, UPLOAD_MAX_SIZE
+)
+from daily_recipe import DailyRecipeCache, accepts_gzip, gzip_etag
+from db import (
+    init_db_pool, create_tables, get_latest_daily_recipe, list_daily_recipes,
+    history_cursor, parse_history_cursor
+)
+from image_pool import ImagePool, ImagePoolBusy
+from metrics import REGISTRY, metrics_middleware, monitor_event_loop, process_memory, register_callback, stage
+from openai_utils import (
+    transcribe_audio_cached, transcribe_audio_stream, analyze_text_with_openai, analyze_image_with_openai,
+    stream_text_with_openai, openai_trace_config, breaker_stats, budget_stats
+)
+from recipe import dumps, parse_recipe, recipe_payload
+from scheduler import run_scheduler, refresh_daily_recipe, regenerate_daily_recipe
+from singleflight import SingleFlight
+from tracing import Tracer, create_exporter, tracing_middleware
+from upload_utils import StreamingUpload, spool_field
 
-# Обработчик для получения рецепта дня
+# Ответ на текстовый вопрос: сначала кэш по нормализованному тексту, потом OpenAI
+async def get_text_recipe(app, text):
+    cache = app['text_cache']
+    key = normalize_text(text)
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info(f"Text cache hit for '{truncate_payload(key)}'")
+            return cached
+
+    # Одинаковые вопросы, пришедшие одновременно, ждут один запрос к OpenAI
+    async def fetch():
+        recipe = await analyze_text_with_openai(app['http_session'], text)
+        if recipe is not None and key:
+            cache.set(key, recipe)
+        return recipe
+
+    return await app['inflight'].do(("text", key or text), fetch)
+
+# Анализ фото: сначала ищем почти такое же фото с той же подписью, потом OpenAI
+async def get_image_recipe(app, compressed_image, image_hash, caption):
+    cache = app['image_cache']
+    tag = normalize_text(caption or "")
+    cached, distance = cache.get(image_hash, tag)
+    if cached is not None:
+        logger.info(f"Image cache hit for hash {image_hash:016x}, distance {distance}")
+        return cached
+
+    async def fetch():
+        recipe = await analyze_image_with_openai(app['http_session'], compressed_image, caption)
+        if recipe is not None:
+            cache.set(image_hash, recipe, tag)
+        return recipe
+
+    return await app['inflight'].do(("image", image_hash, tag), fetch)
+
+# Формат ответа: ?v=2 — рецепт JSON-объектом, иначе строкой (как ждут старые клиенты)
+def wants_typed(request):
+    return request.query.get("v") == "2"
+
+# Ответ с рецептом; сериализация одна, через orjson, если он установлен
+def recipe_response(request, recipe, **extra):
+    return web.Response(
+        body=dumps(recipe_payload(recipe, wants_typed(request), **extra)),
+        content_type="application/json",
+        charset="utf-8"
+    )
+
+# Ответ с рецептом дня из памяти: ETag/304 и заранее сжатое тело
+def daily_recipe_response(request, daily):
+    body, gzip_body, etag = daily.variant(wants_typed(request))
+    use_gzip = accepts_gzip(request.headers.get("Accept-Encoding"))
+    if use_gzip:
+        etag = gzip_etag(etag)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={daily.max_age()}",
+        "Vary": "Accept-Encoding"
+    }
+    if daily.matches(request.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        body = gzip_body
+    return web.Response(body=body, headers=headers, content_type="application/json", charset="utf-8")
+
+# Обработчик для получения рецепта дня (GET /daily_recipe)
 async def handle_daily_recipe(request):
     try:
         logger.info(f"Received daily recipe request from {request.remote}")
-        
-        # Пропускаем multipart данные без чтения в память
+        daily = request.app['daily_recipe']
+        if daily.body is not None:
+            # stale-while-revalidate: отдаём старый рецепт, новый генерируем в фоне
+            if daily.should_revalidate(DAILY_RECIPE_RETRY_INTERVAL):
+                logger.info("Daily recipe is stale, regenerating in background")
+                asyncio.create_task(regenerate_daily_recipe(request.app))
+            return daily_recipe_response(request, daily)
+
+        # В памяти ещё ничего нет (например, пустая БД при старте)
+        recipe_text = await get_latest_daily_recipe(request.app['db_pool'])
+        recipe = parse_recipe(recipe_text) if recipe_text else None
+        if recipe is not None:
+            logger.info("Loaded daily recipe from database")
+            daily.update(recipe)
+            return daily_recipe_response(request, daily)
+
+        # Генерирует один запрос на кластер, остальные ждут его с таймаутом
+        logger.warning("No daily recipe found, fetching new one")
+        try:
+            recipe = await asyncio.wait_for(regenerate_daily_recipe(request.app), DAILY_RECIPE_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out waiting for daily recipe generation")
+            return web.json_response(
+                {"error": "Daily recipe is being generated"},
+                status=503,
+                headers={"Retry-After": "5"}
+            )
+        if recipe is not None:
+            logger.info("Returning newly fetched recipe")
+            return daily_recipe_response(request, daily)
+        else:
+            logger.error("Failed to fetch daily recipe")
+            return web.json_response({"error": "Failed to fetch daily recipe"}, status=500)
+    except Exception as e:
+        logger.error(f"Error handling daily recipe request: {e}")
+        return web.json_response({"error": str(e)}, status=500)
+
+# История рецептов дня от новых к старым: GET /daily_recipes?before=<next>&limit=20
+async def handle_daily_recipes(request):
+    try:
+        limit = int(request.query.get("limit", DAILY_RECIPES_PAGE_SIZE))
+        before = request.query.get("before")
+        cursor = parse_history_cursor(before) if before else None
+    except ValueError:
+        return web.json_response({"error": "Invalid limit or before"}, status=400)
+    if limit < 1:
+        return web.json_response({"error": "Invalid limit or before"}, status=400)
+    limit = min(limit, DAILY_RECIPES_MAX_PAGE_SIZE)
+
+    try:
+        rows = await list_daily_recipes(request.app['db_pool'], limit, cursor)
+        typed = wants_typed(request)
+        recipes = []
+        for row in rows:
+            recipe = parse_recipe(row["recipe"])
+            if recipe is not None:
+                recipes.append({
+                    "id": row["id"],
+                    "created_at": row["created_at"].isoformat(),
+                    **recipe_payload(recipe, typed)
+                })
+
+        # Старые страницы не меняются (история только дописывается), первая — до смены рецепта
+        max_age = 24 * 60 * 60 if cursor else request.app['daily_recipe'].max_age()
+        return web.Response(
+            body=dumps({
+                "recipes": recipes,
+                "next": history_cursor(rows[-1]) if len(rows) == limit else None
+            }),
+            content_type="application/json",
+            charset="utf-8",
+            headers={"Cache-Control": f"public, max-age={max_age}"}
+        )
+    except Exception as e:
+        logger.error(f"Error handling daily recipes request: {e}")
+        return web.json_response({"error": str(e)}, status=500)
+
+# Старый POST /upload_daily_recipe, оставлен для совместимости с клиентами
+async def handle_daily_recipe_legacy(request):
+    # Пропускаем multipart данные без чтения в память
+    if request.body_exists and request.content_type.startswith("multipart/"):
         reader = await request.multipart()
         while True:
             field = await reader.next()
@@ -21,144 +188,422 @@ async def handle_daily_recipe(request):
                 break
             # Пропускаем поле без чтения содержимого
             await field.release()
-        
-        recipe = await get_latest_daily_recipe(request.app['db_pool'])
-        if recipe:
-            logger.info("Returning daily recipe from database")
-            return web.json_response({"recipe": recipe})
-        else:
-            logger.warning("No daily recipe found, fetching new one")
-            recipe_text = await fetch_daily_recipe(request.app['http_session'])
-            if recipe_text:
-                await save_daily_recipe(request.app['db_pool'], recipe_text)
-                logger.info("Returning newly fetched recipe")
-                return web.json_response({"recipe": recipe_text})
-            else:
-                logger.error("Failed to fetch daily recipe")
-                return web.json_response({"error": "Failed to fetch daily recipe"}, status=500)
-    except Exception as e:
-        logger.error(f"Error handling daily recipe request: {e}")
-        return web.json_response({"error": str(e)}, status=500)
+    return await handle_daily_recipe(request)
 
-# Обработчик текстовых запросов
-async def handle_text(request):
+# Чтение поля "text" из multipart-запроса
+async def read_text_field(request):
+    reader = await request.multipart()
+    text_data = None
+    
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+        if field.name == "text":
+            text_data = await field.read()
+            text_data = text_data.decode("utf-8")
+            logger.info(f"Received text: {truncate_payload(text_data)}")
+    return text_data
+
+# Чтение поля "audio" из multipart-запроса: файл пишется в спул кусками.
+# Возвращённый SpooledUpload нужно закрыть.
+async def read_audio_field(request):
+    reader = await request.multipart()
+    audio = None
+    
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+        if field.name == "audio":
+            if audio is not None:
+                audio.close()
+            audio = await spool_field(field, max_size=request.client_max_size)
+            logger.info(f"Received audio file: {audio.filename}, size: {audio.size} bytes")
+    return audio
+
+# Чтение полей "image" (в спул) и "caption" из multipart-запроса
+async def read_image_fields(request):
+    reader = await request.multipart()
+    image = None
+    caption = None
+    
     try:
-        logger.info(f"Received text request from {request.remote}")
-        reader = await request.multipart()
-        text_data = None
-        
         while True:
             field = await reader.next()
             if field is None:
                 break
-            if field.name == "text":
-                text_data = await field.read()
-                text_data = text_data.decode("utf-8")
-                logger.info(f"Received text: {text_data}")
+            if field.name == "image":
+                if image is not None:
+                    image.close()
+                image = await spool_field(field, max_size=request.client_max_size)
+                logger.info(f"Received image of size {image.size} bytes")
+            elif field.name == "caption":
+                caption = await field.read()
+                caption = caption.decode("utf-8")
+                logger.info(f"Received caption: {truncate_payload(caption) if caption else 'None'}")
+    except BaseException:
+        if image is not None:
+            image.close()
+        raise
+    return image, caption
+
+# Расшифровка аудио через кэш и склейку одинаковых запросов
+async def get_transcription(app, audio):
+    return await transcribe_audio_cached(
+        app['http_session'],
+        app['audio_cache'],
+        audio, 
+        flights=app['inflight'],
+        content_type="audio/m4a", 
+        filename=audio.filename or "audio.m4a"
+    )
+
+# Расшифровка поля "audio" прямо во время загрузки (AUDIO_PASSTHROUGH): Whisper
+# получает файл параллельно с клиентом, в памяти — не больше спула
+async def transcribe_audio_passthrough(request):
+    reader = await request.multipart()
+    found = False
+    transcription = None
+
+    while True:
+        field = await reader.next()
+        if field is None:
+            break
+        if field.name == "audio" and not found:
+            found = True
+            logger.info(f"Streaming audio file {field.filename} to Whisper")
+            with StreamingUpload(field, max_size=request.client_max_size) as upload:
+                transcription = await transcribe_audio_stream(
+                    request.app['http_session'],
+                    upload,
+                    content_type="audio/m4a",
+                    filename=field.filename or "audio.m4a"
+                )
+                audio = await upload.finish()
+                logger.info(f"Received audio file: {audio.filename}, size: {audio.size} bytes")
+                if transcription:
+                    request.app['audio_cache'].set(audio.sha256, transcription)
+    return found, transcription
+
+# Расшифровка аудио из запроса: (было ли поле audio, текст или None)
+async def transcribe_request_audio(request):
+    if AUDIO_PASSTHROUGH:
+        return await transcribe_audio_passthrough(request)
+    with stage("multipart"):
+        audio = await read_audio_field(request)
+    if not audio:
+        return False, None
+    try:
+        return True, await get_transcription(request.app, audio)
+    finally:
+        audio.close()
+
+# Обработчик текстовых запросов
+async def handle_text(request):
+    try:
+        logger.info(f"Received text request from {request.remote}")
+        with stage("multipart"):
+            text_data = await read_text_field(request)
 
         if not text_data:
             logger.warning("No text provided in the request")
             return web.json_response({"error": "No text provided"}, status=400)
 
-        response_text = await analyze_text_with_openai(request.app['http_session'], text_data)
-        if not response_text:
+        recipe = await get_text_recipe(request.app, text_data)
+        if recipe is None:
             return web.json_response({"error": "OpenAI request failed"}, status=500)
-            
-        return web.json_response({
-            "transcription": text_data, 
-            "recipe": response_text
-        })
+
+        return recipe_response(request, recipe, transcription=text_data)
     except Exception as e:
         logger.error(f"Error handling text request: {e}")
         return web.json_response({"error": str(e)}, status=500)
 
 # Обработчик аудио
 async def handle_audio(request):
-    temp_path = None
     try:
         logger.info(f"Received audio request from {request.remote}")
-        reader = await request.multipart()
-        audio_data = None
-        audio_filename = None
-        
-        while True:
-            field = await reader.next()
-            if field is None:
-                break
-            if field.name == "audio":
-                audio_data = await field.read()
-                audio_filename = field.filename
-                content_type = field.headers.get('Content-Type', 'unknown')
-                logger.info(f"Received audio file: {audio_filename}, size: {len(audio_data)} bytes")
+        found, transcription = await transcribe_request_audio(request)
 
-        if not audio_data:
+        if not found:
             logger.warning("No audio provided in the request")
             return web.json_response({"error": "No audio provided"}, status=400)
 
-        transcription = await transcribe_audio(
-            request.app['http_session'],
-            audio_data, 
-            content_type="audio/m4a", 
-            filename=audio_filename or "audio.m4a"
-        )
         if not transcription:
             logger.error("Failed to transcribe audio")
             return web.json_response({"error": "Failed to transcribe audio"}, status=500)
 
-        response_text = await analyze_text_with_openai(request.app['http_session'], transcription)
-        if not response_text:
+        recipe = await get_text_recipe(request.app, transcription)
+        if recipe is None:
             return web.json_response({"error": "OpenAI request failed"}, status=500)
-            
-        return web.json_response({
-            "transcription": transcription, 
-            "recipe": response_text
-        })
+
+        return recipe_response(request, recipe, transcription=transcription)
+    except web.HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error handling audio request: {e}")
         return web.json_response({"error": str(e)}, status=500)
+
+# Отправка одного события Server-Sent Events
+async def send_sse(response, event, data):
+    await response.write(f"event: {event}\ndata: ".encode("utf-8") + dumps(data) + b"\n\n")
+
+async def start_sse(request):
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # Чтобы nginx не буферизовал поток
+        "X-Request-ID": request_id_var.get()
+    })
+    await response.prepare(request)
+    return response
+
+# Потоковый ответ на вопрос: события delta с кусками текста по мере генерации
+# и финальное done с проверенным рецептом (тот же формат, что у /upload_text)
+# Все записи в ответ после prepare() могут бросить ConnectionResetError, если
+# клиент ушёл, — её ловят обработчики
+async def stream_text_recipe(app, response, text, typed=False):
+    cache = app['text_cache']
+    key = normalize_text(text)
+    cached = cache.get(key) if key else None
+    if cached is not None:
+        logger.info(f"Text cache hit for '{truncate_payload(key)}'")
+        await send_sse(response, "done", recipe_payload(cached, typed, transcription=text))
+        return
+
+    parts = []
+    stream = stream_text_with_openai(app['http_session'], text)
+    try:
+        async for delta in stream:
+            parts.append(delta)
+            await send_sse(response, "delta", {"text": delta})
+    except ConnectionResetError:
+        raise
+    except Exception as e:
+        logger.error(f"Error streaming OpenAI response: {e}")
+        await send_sse(response, "error", {"error": "OpenAI request failed"})
+        return
     finally:
-        if temp_path and os.path.exists(temp_path):
-            os.remove(temp_path)
-            logger.info(f"Removed temporary file: {temp_path}")
+        # Клиент ушёл — сразу закрываем поток от OpenAI, а не ждём сборщика мусора
+        await stream.aclose()
+
+    recipe = parse_recipe("".join(parts))
+    if recipe is None:
+        logger.error("OpenAI returned invalid JSON in streamed response")
+        await send_sse(response, "error", {"error": "Invalid response from OpenAI"})
+        return
+    if key:
+        cache.set(key, recipe)
+    await send_sse(response, "done", recipe_payload(recipe, typed, transcription=text))
+
+# Потоковый вариант /upload_text
+async def handle_text_stream(request):
+    logger.info(f"Received streaming text request from {request.remote}")
+    with stage("multipart"):
+        text_data = await read_text_field(request)
+    if not text_data:
+        logger.warning("No text provided in the request")
+        return web.json_response({"error": "No text provided"}, status=400)
+
+    response = await start_sse(request)
+    try:
+        await stream_text_recipe(request.app, response, text_data, wants_typed(request))
+        await response.write_eof()
+    except ConnectionResetError:
+        logger.info("Client disconnected during streaming")
+    return response
+
+# Потоковый вариант /upload_audio: сначала событие transcription, затем анализ потоком
+async def handle_audio_stream(request):
+    logger.info(f"Received streaming audio request from {request.remote}")
+    found, transcription = await transcribe_request_audio(request)
+    if not found:
+        logger.warning("No audio provided in the request")
+        return web.json_response({"error": "No audio provided"}, status=400)
+
+    if not transcription:
+        logger.error("Failed to transcribe audio")
+        return web.json_response({"error": "Failed to transcribe audio"}, status=500)
+
+    response = await start_sse(request)
+    try:
+        await send_sse(response, "transcription", {"transcription": transcription})
+        await stream_text_recipe(request.app, response, transcription, wants_typed(request))
+        await response.write_eof()
+    except ConnectionResetError:
+        logger.info("Client disconnected during streaming")
+    return response
 
 # Обработчик запросов для изображений
 async def handle_image(request):
+    image = None
     try:
         logger.info(f"Received image request from {request.remote}")
-        reader = await request.multipart()
-        image_data = None
-        caption = None
+        with stage("multipart"):
+            image, caption = await read_image_fields(request)
         
-        while True:
-            field = await reader.next()
-            if field is None:
-                break
-            if field.name == "image":
-                image_data = await field.read()
-                logger.info(f"Received image of size {len(image_data)} bytes")
-            elif field.name == "caption":
-                caption = await field.read()
-                caption = caption.decode("utf-8")
-                logger.info(f"Received caption: {caption if caption else 'None'}")
-        
-        if not image_data:
+        if not image:
             logger.warning("No image provided in the request")
             return web.json_response({"error": "No image provided"}, status=400)
 
-        # Выполняем в отдельном потоке для избежания блокировки
-        compressed_image = await asyncio.to_thread(compress_image, image_data)
-        response_text = await analyze_image_with_openai(request.app['http_session'], compressed_image, caption)
-        if not response_text:
+        # Сжатие в отдельном пуле процессов; фото передаётся через разделяемую память
+        try:
+            with stage("compress"):
+                compressed_image, image_hash = await request.app['image_pool'].prepare(image)
+        except ImagePoolBusy:
+            logger.warning("Image pool queue is full, rejecting request")
+            return web.json_response(
+                {"error": "Server is busy, try again later"},
+                status=503,
+                headers={"Retry-After": str(IMAGE_POOL_RETRY_AFTER)}
+            )
+        except (asyncio.TimeoutError, BrokenProcessPool) as e:
+            # Пул уже пересоздан (или воркер ещё занят) — клиенту есть смысл повторить
+            logger.error(f"Image compression failed: {e!r}")
+            return web.json_response(
+                {"error": "Image processing failed, try again later"},
+                status=503,
+                headers={"Retry-After": str(IMAGE_POOL_RETRY_AFTER)}
+            )
+        image.close()
+        image = None
+        recipe = await get_image_recipe(request.app, compressed_image, image_hash, caption)
+        if recipe is None:
             return web.json_response({"error": "OpenAI request failed"}, status=500)
-            
+
+        if wants_typed(request):
+            return recipe_response(request, recipe)
+        # Старые клиенты ждут сам рецепт в теле ответа как text/plain
         return web.Response(
-            text=response_text,
+            text=recipe.to_json(),
             content_type="text/plain",
             charset="utf-8"
         )
+    except web.HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error handling image request: {e}")
         return web.json_response({"error": str(e)}, status=500)
+    finally:
+        if image is not None:
+            image.close()
+
+# Статистика кэшей
+async def handle_cache_stats(request):
+    return web.json_response({
+        "text": request.app['text_cache'].stats(),
+        "image": request.app['image_cache'].stats(),
+        "audio": request.app['audio_cache'].stats(),
+        "inflight": request.app['inflight'].stats(),
+        "image_pool": request.app['image_pool'].stats(),
+        "openai_breakers": breaker_stats(),
+        "openai_budgets": budget_stats()
+    })
+
+# Текущая загрузка маршрутов: в работе, в очереди, отброшено
+async def handle_admission_stats(request):
+    return web.json_response({
+        path: limiter.stats() for path, limiter in request.app['admission'].items()
+    })
+
+# Метрики в формате Prometheus
+async def handle_metrics(request):
+    return web.Response(
+        text=REGISTRY.render(),
+        content_type="text/plain",
+        charset="utf-8",
+        headers={"X-Content-Type-Options": "nosniff"}
+    )
+
+# Датчики, которые считываются в момент опроса /metrics
+def register_runtime_metrics(app):
+    def db_pool():
+        pool = app['db_pool']
+        size = pool.get_size()
+        return [
+            (("size",), size),
+            (("in_use",), size - pool.get_idle_size()),
+            (("max",), pool.get_max_size()),
+        ]
+
+    def http_connector():
+        connector = app['http_session'].connector
+        # Занятые соединения — внутреннее поле aiohttp, поэтому осторожно
+        acquired = getattr(connector, "_acquired", ())
+        return [
+            (("in_use",), len(acquired)),
+            (("limit",), connector.limit),
+        ]
+
+    def caches():
+        samples = []
+        for name in ("text_cache", "image_cache", "audio_cache"):
+            stats = app[name].stats()
+            for key in ("size", "hits", "misses", "evictions"):
+                samples.append(((name, key), stats[key]))
+        return samples
+
+    def admission():
+        samples = []
+        for path, limiter in app['admission'].items():
+            stats = limiter.stats()
+            for key in ("in_flight", "queued", "rejected", "timed_out"):
+                samples.append(((path, key), stats[key]))
+        return samples
+
+    def logging_state():
+        return [
+            (("dropped",), queue_handler.dropped),
+            (("suppressed",), rate_limit_filter.suppressed),
+            (("queued",), queue_handler.queue.qsize()),
+        ]
+
+    def image_pool():
+        stats = app['image_pool'].stats()
+        return [((key,), stats[key]) for key in ("pending", "completed", "rejected", "timed_out", "restarts")]
+
+    # Состояние выключателя: 0 — закрыт, 1 — пробный запрос, 2 — открыт
+    def openai_breakers():
+        states = {"closed": 0, "half_open": 1, "open": 2}
+        samples = []
+        for endpoint, stats in breaker_stats().items():
+            samples.append(((endpoint, "state"), states[stats["state"]]))
+            for key in ("failures", "opened_total", "rejected"):
+                samples.append(((endpoint, key), stats[key]))
+        return samples
+
+    def tracer():
+        stats = app['tracer'].stats()
+        return [((key,), stats[key]) for key in ("kept", "sampled_out", "dropped", "queued")]
+
+    def daily_recipe():
+        daily = app['daily_recipe']
+        return [
+            (("buffered",), daily.buffered or 0),
+            (("stale",), int(daily.stale)),
+        ]
+
+    def openai_budgets():
+        samples = []
+        for endpoint, stats in budget_stats().items():
+            for key, value in stats.items():
+                samples.append(((endpoint, key), value))
+        return samples
+
+    register_callback("recipe_db_pool_connections", "asyncpg pool connections", "gauge", ("state",), db_pool)
+    register_callback("recipe_http_connector_connections", "OpenAI TCPConnector connections", "gauge", ("state",), http_connector)
+    register_callback("recipe_cache", "Cache sizes and counters", "gauge", ("cache", "field"), caches)
+    register_callback("recipe_admission", "Admission control state per route", "gauge", ("route", "field"), admission)
+    register_callback("recipe_log_records", "Log records dropped, rate-limited or queued", "gauge", ("state",), logging_state)
+    register_callback("recipe_image_pool", "Image process pool state", "gauge", ("field",), image_pool)
+    register_callback("recipe_openai_breaker", "OpenAI circuit breaker state", "gauge", ("endpoint", "field"), openai_breakers)
+    register_callback("recipe_traces", "Traces kept, sampled out, dropped or queued for export", "gauge", ("state",), tracer)
+    register_callback("recipe_daily_recipe", "Pre-generated daily recipes and staleness", "gauge", ("field",), daily_recipe)
+    register_callback("recipe_openai_budget", "OpenAI rate limit budget and queue", "gauge", ("endpoint", "field"), openai_budgets)
+    register_callback(
+        "recipe_process_memory", "Process resident memory in bytes", "gauge", ("field",),
+        lambda: [((key,), value) for key, value in process_memory().items()]
+    )
 
 # Middleware для обработки ошибок
 async def error_middleware(app, handler):
@@ -175,36 +620,83 @@ async def error_middleware(app, handler):
 # Инициализация приложения
 async def init_app():
     app = web.Application(
-        client_max_size=10*1024*1024,  # Лимит 10 МБ
-        middlewares=[error_middleware]
+        client_max_size=UPLOAD_MAX_SIZE,
+        middlewares=[tracing_middleware, metrics_middleware, error_middleware, admission_middleware]
     )
+    app['tracer'] = Tracer(create_exporter())
+    app['admission'] = create_limiters()
     
     # Инициализация пула БД
     app['db_pool'] = await init_db_pool()
     await create_tables(app['db_pool'])
     
+    # Рецепт дня держим в памяти, чтобы не ходить в БД на каждый запуск приложения
+    app['daily_recipe'] = DailyRecipeCache()
+    recipe_text = await get_latest_daily_recipe(app['db_pool'])
+    recipe = parse_recipe(recipe_text) if recipe_text else None
+    if recipe is not None:
+        app['daily_recipe'].update(recipe)
+    
+    # Кэш ответов на текстовые вопросы
+    app['text_cache'] = TTLCache(max_size=TEXT_CACHE_MAX_SIZE, ttl=TEXT_CACHE_TTL)
+    # Кэш анализа фото по перцептивному хэшу
+    app['image_cache'] = PerceptualHashIndex(
+        max_size=IMAGE_CACHE_MAX_SIZE,
+        ttl=IMAGE_CACHE_TTL,
+        max_distance=IMAGE_HASH_MAX_DISTANCE
+    )
+    # Кэш расшифровок аудио; рецепт по расшифровке берётся из text_cache
+    app['audio_cache'] = TTLCache(max_size=AUDIO_CACHE_MAX_SIZE, ttl=AUDIO_CACHE_TTL)
+    # Склейка одновременных одинаковых запросов к OpenAI
+    app['inflight'] = SingleFlight()
+    
+    # Пул процессов для сжатия фото
+    app['image_pool'] = ImagePool(
+        workers=IMAGE_POOL_WORKERS or None,
+        max_pending=IMAGE_POOL_MAX_PENDING or None,
+        timeout=IMAGE_POOL_TIMEOUT or None
+    )
+    
     # Создаем HTTP-сессию для повторного использования
     connector = aiohttp.TCPConnector(limit=100)  # Увеличиваем лимит соединений
-    app['http_session'] = aiohttp.ClientSession(connector=connector)
+    app['http_session'] = aiohttp.ClientSession(
+        connector=connector,
+        trace_configs=[openai_trace_config()]
+    )
+    register_runtime_metrics(app)
+    app['tracer'].start(app['http_session'])
     
     # Запуск задачи обновления рецепта
-    asyncio.create_task(schedule_daily_recipe_update(app))
+    # Смену рецепта и очередь ведёт один процесс-лидер, новый рецепт подхватывают все
+    asyncio.create_task(run_scheduler(app))
+    asyncio.create_task(refresh_daily_recipe(app))
     logger.info("Scheduled daily recipe update task started")
+    # Задержка event loop для /metrics
+    asyncio.create_task(monitor_event_loop())
     
     # Роутинг
     app.router.add_post("/upload", handle_image)
     app.router.add_post("/upload_audio", handle_audio)
     app.router.add_post("/upload_text", handle_text)
-    app.router.add_post("/upload_daily_recipe", handle_daily_recipe)
+    app.router.add_post("/upload_text_stream", handle_text_stream)
+    app.router.add_post("/upload_audio_stream", handle_audio_stream)
+    app.router.add_get("/daily_recipe", handle_daily_recipe)
+    app.router.add_get("/daily_recipes", handle_daily_recipes)
+    app.router.add_post("/upload_daily_recipe", handle_daily_recipe_legacy)
+    app.router.add_get("/cache_stats", handle_cache_stats)
+    app.router.add_get("/admission_stats", handle_admission_stats)
+    app.router.add_get("/metrics", handle_metrics)
     
     # Обработчик закрытия сессии при остановке
     async def close_session(app):
+        await app['tracer'].stop()
         await app['http_session'].close()
+        app['image_pool'].shutdown()
     app.on_cleanup.append(close_session)
     
     return app
 
-# Запуск сервера
+# Запуск сервера в одном процессе; несколько воркеров на одном порту — runner.py
 if __name__ == "__main__":
-    logger.info("Starting server on 127.0.0.1:8080...")
-    web.run_app(init_app(), host="127.0.0.1", port=8080)
\ No newline at end of file
+    logger.info(f"Starting server on {SERVER_HOST}:{SERVER_PORT}...")
+    web.run_app(init_app(), host=SERVER_HOST, port=SERVER_PORT, shutdown_timeout=SERVER_SHUTDOWN_TIMEOUT)
\ No newline at end of file
@@ -0,0 +1,41 @@
+import asyncio
+
+class SingleFlight:
+    # Склеивает одновременные одинаковые вызовы: первый запускает задачу,
+    # остальные ждут её же результат. Ожидающие защищены через shield —
+    # отмена одного (клиент отключился) не отменяет вызов для остальных,
+    # а начатый запрос к OpenAI доводится до конца и попадает в кэш.
+
+    def __init__(self):
+        self._calls = {}
+        self.started = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Забираем исключение, чтобы не было "Task exception was never retrieved",
+        # если все ожидающие уже ушли
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.started += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "started": self.started,
+            "shared": self.shared,
+        }
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# config требует ключ OpenAI и настройки БД; в тестах ни то, ни другое не используется
+os.environ.setdefault("OPENAI_API_KEY", "test")
+for name in ("DB_HOST", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+    os.environ.setdefault(name, "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
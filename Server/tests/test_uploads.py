@@ -0,0 +1,36 @@
+import asyncio
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+import server
+
+MAX_SIZE = 1024 * 1024
+
+async def _post(path, handler, field, size):
+    app = web.Application(client_max_size=MAX_SIZE, middlewares=[server.error_middleware])
+    app.router.add_post(path, handler)
+    async with TestClient(TestServer(app)) as client:
+        data = aiohttp.FormData()
+        data.add_field(field, b"\0" * size, filename="upload.bin", content_type="application/octet-stream")
+        response = await client.post(path, data=data)
+        return response.status, await response.json()
+
+def test_oversized_image_is_rejected():
+    status, body = asyncio.run(_post("/upload", server.handle_image, "image", MAX_SIZE + 1))
+    assert status == 413
+    assert body["error"] == "Request Entity Too Large"
+
+def test_oversized_audio_is_rejected():
+    status, _ = asyncio.run(_post("/upload_audio", server.handle_audio, "audio", 4 * MAX_SIZE))
+    assert status == 413
+
+def test_image_at_limit_is_read():
+    # Ровно client_max_size проходит проверку размера и доходит до сжатия
+    async def handler(request):
+        image, _ = await server.read_image_fields(request)
+        with image:
+            return web.json_response({"size": image.size})
+
+    status, body = asyncio.run(_post("/upload", handler, "image", MAX_SIZE))
+    assert status == 200
+    assert body["size"] == MAX_SIZE
@@ -0,0 +1,262 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import time
+import uuid
+from config import (
+    logger, request_id_var, TRACE_EXPORT, TRACE_JSONL_PATH, TRACE_OTLP_URL,
+    TRACE_SLOW_THRESHOLD, TRACE_SAMPLE_RATE, TRACE_QUEUE_SIZE
+)
+
+# Трасса запроса и текущий спан передаются через contextvars, поэтому
+# вложенные вызовы (openai_utils, db, пул картинок) ничего не знают о запросе,
+# а задачи, созданные внутри запроса, наследуют его контекст.
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if error is not None:
+            self.error = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+            self.trace.failed = True
+        self.trace.add(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace.trace_id,
+            "request_id": self.trace.request_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class Trace:
+    def __init__(self, request_id):
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.spans = []
+        self.failed = False
+        self.finished = False
+
+    def add(self, span):
+        # Спаны фоновых задач, доживших дольше запроса, уже не нужны
+        if not self.finished:
+            self.spans.append(span)
+
+class _SpanContext:
+    __slots__ = ("_name", "_attributes", "_span", "_token")
+
+    def __init__(self, name, attributes):
+        self._name = name
+        self._attributes = attributes
+        self._span = None
+
+    def __enter__(self):
+        self._span = start_span(self._name, **self._attributes)
+        if self._span is not None:
+            self._token = _current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is not None:
+            _current_span.reset(self._token)
+            self._span.finish(exc)
+        return False
+
+# Спан без смены текущего (для колбэков, где нет общего with-блока);
+# вне запроса возвращает None
+def start_span(name, **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    parent = _current_span.get()
+    return Span(trace, name, parent.span_id if parent else None, attributes)
+
+# with span("db.query", sql="..."): ...
+def span(name, **attributes):
+    return _SpanContext(name, attributes)
+
+class JsonlExporter:
+    # Одна строка на спан; запись на диск — в отдельном потоке
+    def __init__(self, path):
+        self.path = path
+
+    def _write(self, lines):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    async def export(self, session, traces):
+        lines = [
+            json.dumps(span.to_dict(), ensure_ascii=False) + "\n"
+            for trace in traces
+            for span in trace.spans
+        ]
+        await asyncio.to_thread(self._write, lines)
+
+class OtlpExporter:
+    # OTLP/HTTP в JSON-кодировке: подходит коллектор OpenTelemetry или любая заглушка
+    def __init__(self, url, service_name="recipe-server"):
+        self.url = url
+        self.service_name = service_name
+
+    def _span(self, span):
+        attributes = [
+            {"key": key, "value": {"stringValue": str(value)}}
+            for key, value in span.attributes.items()
+        ]
+        attributes.append({"key": "request_id", "value": {"stringValue": span.trace.request_id}})
+        result = {
+            "traceId": span.trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(span.start * 1e9)),
+            "endTimeUnixNano": str(int(span.end * 1e9)),
+            "attributes": attributes,
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            result["parentSpanId"] = span.parent_id
+        return result
+
+    async def export(self, session, traces):
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": self.service_name}},
+                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "recipe.tracing"},
+                    "spans": [self._span(span) for trace in traces for span in trace.spans],
+                }],
+            }]
+        }
+        async with session.post(self.url, json=body) as response:
+            if response.status >= 300:
+                logger.warning(f"Trace export failed: {response.status}")
+
+def create_exporter(kind=TRACE_EXPORT):
+    if kind == "jsonl":
+        return JsonlExporter(TRACE_JSONL_PATH)
+    if kind == "otlp":
+        return OtlpExporter(TRACE_OTLP_URL)
+    return None
+
+class Tracer:
+    # Tail-based sampling: решение о сохранении принимается после завершения
+    # запроса — остаются медленные и упавшие трассы (и доля sample_rate прочих).
+    # Выгрузка пачками в фоне, при переполнении очереди трассы отбрасываются.
+
+    def __init__(self, exporter, slow_threshold=TRACE_SLOW_THRESHOLD,
+                 sample_rate=TRACE_SAMPLE_RATE, queue_size=TRACE_QUEUE_SIZE):
+        self.exporter = exporter
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+        self.kept = 0
+        self.sampled_out = 0
+        self.dropped = 0
+
+    def start_trace(self, request_id=None):
+        request_id = request_id or uuid.uuid4().hex[:16]
+        trace = Trace(request_id)
+        return trace, _current_trace.set(trace), request_id_var.set(request_id)
+
+    def end_trace(self, trace, tokens, duration):
+        trace.finished = True
+        _current_trace.reset(tokens[0])
+        request_id_var.reset(tokens[1])
+        if self.exporter is None:
+            return
+        if not (trace.failed or duration >= self.slow_threshold or random.random() < self.sample_rate):
+            self.sampled_out += 1
+            return
+        try:
+            self._queue.put_nowait(trace)
+            self.kept += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self, session):
+        if self.exporter is not None:
+            self._task = asyncio.create_task(self._run(session))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self, session):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < 100:
+                batch.append(self._queue.get_nowait())
+            try:
+                await self.exporter.export(session, batch)
+            except Exception as e:
+                logger.warning(f"Trace export error: {e}")
+
+    def stats(self):
+        return {
+            "kept": self.kept,
+            "sampled_out": self.sampled_out,
+            "dropped": self.dropped,
+            "queued": self._queue.qsize(),
+        }
+
+# Middleware: id запроса (из X-Request-ID или новый), корневой спан и решение о сэмплинге
+async def tracing_middleware(app, handler):
+    async def middleware_handler(request):
+        tracer = app['tracer']
+        trace, *tokens = tracer.start_trace(request.headers.get("X-Request-ID"))
+        root = Span(trace, f"{request.method} {request.path}", None, {"remote": request.remote})
+        span_token = _current_span.set(root)
+        started = time.perf_counter()
+        error = None
+        response = None
+        try:
+            response = await handler(request)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if response is not None:
+                root.set("status", response.status)
+                if response.status >= 500:
+                    error = f"HTTP {response.status}"
+                if not response.prepared:
+                    response.headers["X-Request-ID"] = trace.request_id
+            _current_span.reset(span_token)
+            root.finish(error)
+            tracer.end_trace(trace, tokens, time.perf_counter() - started)
+    return middleware_handler
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import resource
+import tempfile
+from aiohttp import web
+from config import logger, UPLOAD_MAX_SIZE, UPLOAD_SPOOL_MAX_MEMORY, UPLOAD_CHUNK_SIZE
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss():
+    # Текущий RSS процесса в байтах; вне Linux — пиковый из getrusage
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+def peak_rss():
+    # ru_maxrss в Linux в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# read_chunk(), в отличие от BodyPartReader.read(), не проверяет client_max_size:
+# считаем размер сами и отвечаем тем же 413
+def check_upload_size(size, max_size):
+    if max_size and size > max_size:
+        raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+
+class SpooledUpload:
+    # Загруженный файл: до UPLOAD_SPOOL_MAX_MEMORY в памяти, дальше на диске.
+    # SHA-256 считается на лету, пока читаем поле.
+
+    def __init__(self, file, size, sha256, filename=None, content_type=None):
+        self.file = file
+        self.size = size
+        self.sha256 = sha256
+        self.filename = filename
+        self.content_type = content_type
+
+    @property
+    def on_disk(self):
+        return getattr(self.file, "_rolled", False)
+
+    def __len__(self):
+        return self.size
+
+    def iter_chunks(self, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class StreamingUpload:
+    # Поле multipart, которое отдаётся дальше по мере загрузки: chunks() выдаёт
+    # куски, как они приходят от клиента, и попутно пишет их в спул. После конца
+    # поля есть обычный SpooledUpload — для повтора запроса и ключа кэша.
+    # Сверх max_size chunks() и finish() бросают HTTPRequestEntityTooLarge, а
+    # on_too_large() вызывается сразу — чтобы отменить запрос, читающий chunks().
+
+    def __init__(self, field, max_size=UPLOAD_MAX_SIZE, max_memory=UPLOAD_SPOOL_MAX_MEMORY,
+                 chunk_size=UPLOAD_CHUNK_SIZE, on_too_large=None):
+        self.field = field
+        self.filename = field.filename
+        self.content_type = field.headers.get("Content-Type")
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.on_too_large = on_too_large
+        self.size = 0
+        self.upload = None
+        self.error = None
+        self._spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._digest = hashlib.sha256()
+
+    async def chunks(self):
+        # Продолжает с места, где остановился прерванный предыдущий вызов
+        while self.upload is None:
+            if self.error is not None:
+                raise self.error
+            chunk = await self.field.read_chunk(self.chunk_size)
+            if not chunk:
+                self._spool.seek(0)
+                self.upload = SpooledUpload(
+                    self._spool, self.size, self._digest.hexdigest(),
+                    filename=self.filename, content_type=self.content_type
+                )
+                logger.info(f"Streamed upload '{self.field.name}': {self.size} bytes")
+                break
+            self.size += len(chunk)
+            try:
+                check_upload_size(self.size, self.max_size)
+            except web.HTTPRequestEntityTooLarge as e:
+                self.error = e
+                self._spool.close()
+                if self.on_too_large is not None:
+                    self.on_too_large()
+                raise
+            self._spool.write(chunk)
+            self._digest.update(chunk)
+            yield chunk
+
+    async def finish(self):
+        # Дочитать поле (если отправка оборвалась) и вернуть SpooledUpload
+        async for _ in self.chunks():
+            pass
+        return self.upload
+
+    def close(self):
+        self._spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Потоковое чтение multipart-поля без буферизации всего файла в памяти
+async def spool_field(field, max_size=UPLOAD_MAX_SIZE, max_memory=UPLOAD_SPOOL_MAX_MEMORY, chunk_size=UPLOAD_CHUNK_SIZE):
+    rss_before = current_rss()
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = await field.read_chunk(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            check_upload_size(size, max_size)
+            spool.write(chunk)
+            digest.update(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+
+    upload = SpooledUpload(
+        spool, size, digest.hexdigest(),
+        filename=field.filename,
+        content_type=field.headers.get("Content-Type")
+    )
+    rss_after = current_rss()
+    logger.info(
+        f"Spooled upload '{field.name}': {size} bytes ({'disk' if upload.on_disk else 'memory'}), "
+        f"RSS {rss_after / (1024 * 1024):.1f} MB ({(rss_after - rss_before) / (1024 * 1024):+.1f} MB), "
+        f"peak RSS {peak_rss() / (1024 * 1024):.1f} MB"
+    )
+    return upload
@@ -0,0 +1,57 @@
+import base64
+import json
+import secrets
+import time
+from aiohttp import payload
+
+# Тела запросов к OpenAI, которые пишутся в сокет по частям, без сборки всего
+# запроса в памяти.
+
+# Метка места для base64 в шаблоне JSON. Случайная на процесс, чтобы её не
+# подставил пользователь (например, в подписи к фото).
+BASE64_MARKER = f"@@base64-{secrets.token_hex(8)}@@"
+
+# Сколько байт данных кодировать за раз; кратно 3, чтобы куски base64 склеивались без '='
+BASE64_CHUNK_SIZE = 48 * 1024
+
+def base64_length(size):
+    return (size + 2) // 3 * 4
+
+# JSON-шаблон с BASE64_MARKER в одной из строк -> (байты до метки, байты после).
+# Сериализуется как json= в aiohttp (json.dumps, ASCII).
+def split_json_template(template):
+    text = json.dumps(template)
+    if text.count(BASE64_MARKER) != 1:
+        raise ValueError("JSON template must contain exactly one base64 marker")
+    prefix, _, suffix = text.partition(BASE64_MARKER)
+    return prefix.encode("ascii"), suffix.encode("ascii")
+
+class Base64JsonPayload(payload.Payload):
+    # JSON-тело: prefix + base64(data) + suffix. base64 считается кусками прямо при
+    # записи в сокет: нет ни строки base64 на весь файл, ни data URL, ни копии в
+    # json.dumps. Размер известен заранее — уходит с Content-Length, без chunked.
+    # Новый объект на каждую попытку: aiohttp закрывает тело после отправки.
+    # encode_seconds — время кодирования base64 без ожидания сокета.
+
+    _autoclose = True
+
+    def __init__(self, prefix, data, suffix, **kwargs):
+        super().__init__(data, content_type="application/json", **kwargs)
+        self._prefix = prefix
+        self._data = memoryview(data)
+        self._suffix = suffix
+        self._size = len(prefix) + base64_length(len(data)) + len(suffix)
+        self.encode_seconds = 0.0
+
+    async def write(self, writer):
+        await writer.write(self._prefix)
+        for start in range(0, len(self._data), BASE64_CHUNK_SIZE):
+            started = time.perf_counter()
+            chunk = base64.b64encode(self._data[start:start + BASE64_CHUNK_SIZE])
+            self.encode_seconds += time.perf_counter() - started
+            await writer.write(chunk)
+        await writer.write(self._suffix)
+
+    def decode(self, encoding="utf-8", errors="strict"):
+        # Полная копия тела — только для отладки
+        return (self._prefix + base64.b64encode(self._data) + self._suffix).decode(encoding, errors)